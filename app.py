@@ -1,12 +1,31 @@
+import hashlib
 import locale
 import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
 
 import pytz
 import pywikibot
-from flask import Flask, abort
+from flask import Flask, Response, abort, jsonify, make_response, request, stream_with_context, url_for
 
-from criteria import CriteriaChecker
+from cache import SingleFlight, TTLCache
+from contributions import summarizeContributions
+from criteria import (
+    AUTOREVIEW_THRESHOLDS,
+    REVIEW_THRESHOLDS,
+    CriteriaCheck,
+    CriteriaChecker,
+    GroupThresholds,
+    UserData,
+    UserDataFetchError,
+)
+
+if TYPE_CHECKING:
+    # numpy is only imported by the background jobs and the batch endpoint
+    from batcheval import FeatureTable
 
 if platform.system() == "Darwin":
     locale.setlocale(locale.LC_ALL, "de_DE.UTF-8")
@@ -14,46 +33,301 @@ else:
     locale.setlocale(locale.LC_ALL, "de_DE.utf8")
 
 app = Flask("flaggedrevscrit")
+app.config.update(
+    FETCH_WORKERS=16,
+    FETCH_TIMEOUT=60,
+    FLAGGED_COUNT_BACKEND="api",
+    REPLICA_POOL_SIZE=4,
+    FLAGGED_STATUS_REQUESTS=4,
+    RESULT_CACHE_TTL=600,
+    RESULT_CACHE_SIZE=1000,
+    IN_FLIGHT_TIMEOUT=120,
+    # users with at least this many edits are checked by a background job
+    JOB_EDIT_COUNT=5000,
+    JOB_WORKERS=2,
+    JOB_TTL=3600,
+    # None checks the whole contribution history
+    JOB_CONTRIBUTION_LIMIT=None,
+    BATCH_MAX_USERS=100,
+)
+app.config.from_prefixed_env("FLAGGEDREVSCRIT")
 site = pywikibot.Site()
 site.login()
 timezone = pytz.timezone("Europe/Berlin")
-criteriaChecker = CriteriaChecker(site)
+criteriaChecker = CriteriaChecker(
+    site,
+    fetchWorkers=app.config["FETCH_WORKERS"],
+    defaultFetchTimeout=app.config["FETCH_TIMEOUT"],
+    flaggedCountBackend=app.config["FLAGGED_COUNT_BACKEND"],
+    replicaPoolSize=app.config["REPLICA_POOL_SIZE"],
+    flaggedStatusRequests=app.config["FLAGGED_STATUS_REQUESTS"],
+)
+resultCache = TTLCache(app.config["RESULT_CACHE_SIZE"], app.config["RESULT_CACHE_TTL"])
+inFlightComputations = SingleFlight()
+jobExecutor = ThreadPoolExecutor(max_workers=app.config["JOB_WORKERS"])
+jobs = TTLCache(app.config["RESULT_CACHE_SIZE"], app.config["JOB_TTL"])
+jobsLock = threading.Lock()
 
 
-@app.route("/<wiki>/<username>")
-def checkCriteria(wiki: str, username: str) -> str:
-    user = pywikibot.User(site, username)
-    if not user.isRegistered():
-        abort(400, "User not found.")
+@dataclass
+class CachedResult:
+    html: str
+    etag: str
+    computedAt: datetime
 
-    if user.editCount() >= 5000:
-        return "This tool only works for users with less than 5000 edits."
 
-    userData = criteriaChecker.getUserData(user, datetime.now(), True)
+@dataclass
+class Job:
+    jobId: str
+    username: str
+    result: Optional[CachedResult] = None
+    error: Optional[str] = None
 
-    crit = criteriaChecker.checkUserEligibleForAutoReviewGroup(userData)
-    res = ""
-    if not list(filter(lambda criteria: not criteria.met, crit)):
-        res += f"Benutzer:{username} erfüllt die Kriterien für passive Sichterrechte:"
-    else:
-        res += f"Benutzer:{username} erfüllt die Kriterien für passive Sichterrechte NICHT:"
-    res += "<ul>"
-    for c in crit:
-        res += f'<li style="color:{ "green" if c.met else "red"}">' + c.text + "</li>"
-    res += "</ul>"
-
-    crit = criteriaChecker.checkUserEligibleForReviewGroup(userData)
-    if not list(filter(lambda criteria: not criteria.met, crit)):
-        res += f"Benutzer:{username} erfüllt die Kriterien für aktive Sichterrechte:"
-    else:
-        res += f"Benutzer:{username} erfüllt die Kriterien für aktive Sichterrechte NICHT:"
-    res += "<ul>"
-    for c in crit:
-        res += f'<li style="color:{ "green" if c.met else "red"}">' + c.text + "</li>"
-    res += "</ul>"
 
+def renderCriteria(username: str, userData: UserData) -> str:
+    return renderCriteriaChecks(
+        username,
+        criteriaChecker.checkUserEligibleForAutoReviewGroup(userData),
+        criteriaChecker.checkUserEligibleForReviewGroup(userData),
+    )
+
+
+def renderVerdict(username: str, groupName: str, criteriaChecks: List[CriteriaCheck]) -> str:
+    if not list(filter(lambda criteria: not criteria.met, criteriaChecks)):
+        return f"Benutzer:{username} erfüllt die Kriterien für {groupName} Sichterrechte:"
+    return f"Benutzer:{username} erfüllt die Kriterien für {groupName} Sichterrechte NICHT:"
+
+
+def renderCriteriaCheck(criteria: CriteriaCheck) -> str:
+    return f'<li style="color:{ "green" if criteria.met else "red"}">' + criteria.text + "</li>"
+
+
+def renderCriteriaChecks(
+    username: str, autoReviewCriteriaChecks: List[CriteriaCheck], reviewCriteriaChecks: List[CriteriaCheck]
+) -> str:
+    res = ""
+    for groupName, crit in (("passive", autoReviewCriteriaChecks), ("aktive", reviewCriteriaChecks)):
+        res += renderVerdict(username, groupName, crit)
+        res += "<ul>"
+        for c in crit:
+            res += renderCriteriaCheck(c)
+        res += "</ul>"
     return res
 
 
+def streamCriteria(cacheKey: Tuple[Any, ...], user: pywikibot.User) -> Iterator[str]:
+    # Every criterion is sent as soon as its data is there, the verdict of a group follows its criteria.
+    # The complete result is cached like a non-streamed one.
+    yield f"Prüfe Benutzer:{user.username}..."
+    try:
+        userData = criteriaChecker.getUserData(user, datetime.now(), True)
+        criteriaChecker.startPrefetch(userData)
+        groupResults = []
+        for groupName, thresholds in (("passive", AUTOREVIEW_THRESHOLDS), ("aktive", REVIEW_THRESHOLDS)):
+            crit = []
+            yield "<ul>"
+            for criteria in criteriaChecker.iterUserEligibleForGroup(userData, thresholds):
+                crit.append(criteria)
+                yield renderCriteriaCheck(criteria)
+            yield "</ul>"
+            yield renderVerdict(username=user.username, groupName=groupName, criteriaChecks=crit).rstrip(":") + "."
+            groupResults.append(crit)
+    except Exception as e:  # pylint: disable=broad-except
+        # the status code has already been sent
+        yield f'<p style="color:red">Die Prüfung ist fehlgeschlagen: {e!r}</p>'
+        return
+    html = renderCriteriaChecks(user.username, *groupResults)
+    resultCache.put(cacheKey, CachedResult(html, hashlib.sha1(html.encode()).hexdigest(), datetime.now(pytz.utc)))
+
+
+def computeResult(cacheKey: Tuple[Any, ...], user: pywikibot.User) -> CachedResult:
+    try:
+        userData = criteriaChecker.getUserData(user, datetime.now(), True, prefetch=True)
+    except UserDataFetchError as e:
+        abort(503, str(e))
+    html = renderCriteria(user.username, userData)
+    result = CachedResult(html, hashlib.sha1(html.encode()).hexdigest(), datetime.now(pytz.utc))
+    resultCache.put(cacheKey, result)
+    return result
+
+
+def computeJobResult(cacheKey: Tuple[Any, ...], job: Job) -> None:
+    # a single pass over the whole contribution history that only keeps counts and the newest timestamps
+    from batcheval import (  # pylint: disable=import-outside-toplevel
+        RECENT_EDIT_COLUMNS,
+        FeatureTable,
+        explainUser,
+        extractFeaturesFromSummaries,
+    )
+
+    try:
+        user = pywikibot.User(site, job.username)
+        now = datetime.now()
+        userData = criteriaChecker.getUserData(user, now, True)
+        contribSummary, articleContribSummary = summarizeContributions(
+            user, RECENT_EDIT_COLUMNS, total=app.config["JOB_CONTRIBUTION_LIMIT"], start=now
+        )
+        table = FeatureTable.fromFeatures(
+            [
+                (
+                    user.username,
+                    extractFeaturesFromSummaries(criteriaChecker, userData, contribSummary, articleContribSummary),
+                )
+            ]
+        )
+        html = renderCriteriaChecks(
+            user.username,
+            explainUser(criteriaChecker, table, 0, AUTOREVIEW_THRESHOLDS),
+            explainUser(criteriaChecker, table, 0, REVIEW_THRESHOLDS),
+        )
+        job.result = CachedResult(html, hashlib.sha1(html.encode()).hexdigest(), datetime.now(pytz.utc))
+        resultCache.put(cacheKey, job.result)
+    except Exception as e:  # pylint: disable=broad-except
+        job.error = repr(e)
+
+
+def startJob(cacheKey: Tuple[Any, ...], username: str) -> Job:
+    # the job id is derived from the cache key, so repeated requests for an unchanged user share the job
+    jobId = hashlib.sha1(repr(cacheKey).encode()).hexdigest()
+    with jobsLock:
+        job = jobs.get(jobId)
+        if job is None or job.error is not None:
+            job = Job(jobId, username)
+            jobs.put(jobId, job)
+            jobExecutor.submit(computeJobResult, cacheKey, job)
+    return job
+
+
+def renderResult(result: CachedResult) -> Response:
+    response = make_response(result.html)
+    response.set_etag(result.etag)
+    response.last_modified = result.computedAt
+    return response.make_conditional(request)
+
+
+def getBatchGroupVerdicts(table: "FeatureTable", thresholds: GroupThresholds) -> List[Dict[str, Any]]:
+    from batcheval import evaluateGroup, explainUser  # pylint: disable=import-outside-toplevel
+
+    results = evaluateGroup(table, thresholds)
+    return [
+        {
+            "eligible": bool(results["eligible"][index]),
+            "checks": {name: bool(met[index]) for name, met in results.items() if name != "eligible"},
+            "criteria": [
+                {"met": criteria.met, "text": criteria.text}
+                for criteria in explainUser(criteriaChecker, table, index, thresholds)
+            ],
+        }
+        for index in range(len(table))
+    ]
+
+
+@app.route("/<wiki>/batch", methods=["POST"])
+def checkCriteriaBatch(wiki: str) -> Response:
+    # {"usernames": [...]}, all users are checked together with batched API and replica queries
+    from batcheval import loadFeatureTable  # pylint: disable=import-outside-toplevel
+
+    data = request.get_json(silent=True)
+    usernames = data.get("usernames") if isinstance(data, dict) else None
+    if not isinstance(usernames, list) or not all(isinstance(username, str) and username for username in usernames):
+        abort(400, 'Expected a JSON object with a list of usernames: {"usernames": [...]}.')
+    if len(usernames) > app.config["BATCH_MAX_USERS"]:
+        abort(400, f"At most {app.config['BATCH_MAX_USERS']} users can be checked at once.")
+    try:
+        users = [pywikibot.User(site, username) for username in usernames]
+    except (pywikibot.exceptions.Error, ValueError) as e:
+        abort(400, str(e))
+    metadata = criteriaChecker.userMetadata.load(user.username for user in users)
+    # like on the single user page users with many edits are only checked by a background job
+    tooManyEdits = {
+        username
+        for username, userMetadata in metadata.items()
+        if userMetadata.editCount >= app.config["JOB_EDIT_COUNT"]
+    }
+    table = loadFeatureTable(
+        criteriaChecker,
+        {username: userMetadata for username, userMetadata in metadata.items() if username not in tooManyEdits},
+    )
+    verdicts: Dict[str, Dict[str, Any]] = {
+        username: {
+            "username": username,
+            "exists": True,
+            "tooManyEdits": True,
+            "url": url_for("checkCriteria", wiki=wiki, username=username),
+        }
+        for username in tooManyEdits
+    }
+    for username, autoReview, review in zip(
+        table.usernames,
+        getBatchGroupVerdicts(table, AUTOREVIEW_THRESHOLDS),
+        getBatchGroupVerdicts(table, REVIEW_THRESHOLDS),
+    ):
+        verdicts[username] = {"username": username, "exists": True, "autoreview": autoReview, "review": review}
+    return jsonify(
+        {
+            "checkedAt": table.createdAt.astimezone(pytz.utc).isoformat(),
+            "users": [verdicts.get(user.username, {"username": user.username, "exists": False}) for user in users],
+        }
+    )
+
+
+@app.route("/jobs/<jobId>")
+def jobStatus(jobId: str) -> Response:
+    job = jobs.get(jobId)
+    if job is None:
+        abort(404, "Unknown or expired job.")
+    if job.error is not None:
+        abort(500, f"The check of {job.username} failed: {job.error}")
+    if job.result is not None:
+        return renderResult(job.result)
+    jobUrl = url_for("jobStatus", jobId=jobId)
+    response = make_response(
+        f'<meta http-equiv="refresh" content="10">Die Prüfung von Benutzer:{job.username} läuft noch.'
+        f' Das Ergebnis erscheint unter <a href="{jobUrl}">{jobUrl}</a>.',
+        202,
+    )
+    response.headers["Retry-After"] = "10"
+    return response
+
+
+@app.route("/<wiki>/<username>")
+def checkCriteria(wiki: str, username: str) -> Response:
+    user = pywikibot.User(site, username)
+    metadata = criteriaChecker.userMetadata.load([user.username]).get(user.username)
+    if not metadata:
+        abort(400, "User not found.")
+
+    # any new edit, block or group change results in a different key
+    lastEdit = user.last_edit
+    cacheKey = (
+        wiki,
+        user.username,
+        lastEdit[1] if lastEdit else None,
+        metadata.editCount,
+        metadata.blocked,
+        tuple(metadata.groups),
+    )
+    result = resultCache.get(cacheKey)
+    if result is None and metadata.editCount >= app.config["JOB_EDIT_COUNT"]:
+        # too slow for a request, the client polls the job instead
+        job = startJob(cacheKey, user.username)
+        response = jobStatus(job.jobId)
+        if response.status_code == 202:
+            response.headers["Location"] = url_for("jobStatus", jobId=job.jobId)
+        return response
+    if result is None and request.args.get("stream") == "1":
+        return Response(stream_with_context(streamCriteria(cacheKey, user)), mimetype="text/html")
+    if result is None:
+        # concurrent requests for the same user share a single computation
+        try:
+            result = inFlightComputations.do(
+                cacheKey, lambda: computeResult(cacheKey, user), app.config["IN_FLIGHT_TIMEOUT"]
+            )
+        except TimeoutError:
+            abort(504, "Timed out waiting for the result.")
+
+    return renderResult(result)
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import dataclasses
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pywikibot
+
+from contributions import ContributionSummary, toEpoch
+from criteria import AUTOREVIEW_THRESHOLDS, REVIEW_THRESHOLDS, CriteriaCheck, CriteriaChecker, GroupThresholds, UserData
+from usermetadata import UserMetadata
+
+# number of newest article edit timestamps kept per user for the recent article edit criterion
+RECENT_EDIT_COLUMNS = 50
+
+# unknown flagged edit count, it is only loaded if the content edits are not sufficient
+UNKNOWN_FLAGGED_EDIT_COUNT = -1
+
+FEATURE_COLUMNS = {
+    "registrationTime": np.int64,
+    "editCount": np.int64,
+    "blocked": np.bool_,
+    "isBot": np.bool_,
+    "hasReviewRight": np.bool_,
+    "hasAutoReviewRight": np.bool_,
+    "wasBlockedBefore": np.bool_,
+    "hadReviewRightsRemovedBefore": np.bool_,
+    "totalContentEdits": np.int64,
+    "articlePageCount": np.int64,
+    "customSummaryCount": np.int64,
+    "revertedEdits": np.float64,
+    "flaggedEditCount": np.int64,
+    "contribCount": np.int64,
+    "articleContribCount": np.int64,
+    "spacedEditCount": np.int64,
+    "articleSpacedEditCount": np.int64,
+}
+
+
+@dataclass
+class FeatureTable:
+    usernames: List[str]
+    columns: Dict[str, np.ndarray]
+    # the time the features were fetched, the age and recent edit criteria are evaluated relative to it
+    createdAt: datetime = field(default_factory=datetime.now)
+
+    @staticmethod
+    def fromFeatures(features: Iterable[Tuple[str, Dict[str, Any]]]) -> "FeatureTable":
+        features = list(features)
+        columns = {
+            name: np.array([row[name] for _, row in features], dtype=dtype) for name, dtype in FEATURE_COLUMNS.items()
+        }
+        recentArticleEditTimestamps = np.zeros((len(features), RECENT_EDIT_COLUMNS), dtype=np.int64)
+        for index, (_, row) in enumerate(features):
+            timestamps = row["recentArticleEditTimestamps"]
+            recentArticleEditTimestamps[index, : len(timestamps)] = timestamps
+        columns["recentArticleEditTimestamps"] = recentArticleEditTimestamps
+        return FeatureTable([username for username, _ in features], columns)
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(
+            path,
+            usernames=np.array(self.usernames, dtype=np.str_),
+            createdAt=np.array(self.createdAt.isoformat()),
+            **self.columns,
+        )
+
+    @staticmethod
+    def load(path: str) -> "FeatureTable":
+        with np.load(path, allow_pickle=False) as snapshot:
+            columns = {name: snapshot[name] for name in list(FEATURE_COLUMNS) + ["recentArticleEditTimestamps"]}
+            return FeatureTable(
+                snapshot["usernames"].tolist(), columns, datetime.fromisoformat(str(snapshot["createdAt"]))
+            )
+
+    def __len__(self) -> int:
+        return len(self.usernames)
+
+
+def extractFeatures(
+    criteriaChecker: CriteriaChecker,
+    userData: UserData,
+    groups: Iterable[GroupThresholds] = (REVIEW_THRESHOLDS, AUTOREVIEW_THRESHOLDS),
+    withFlaggedEditCount: bool = False,
+) -> Dict[str, Any]:
+    return extractFeaturesFromSummaries(
+        criteriaChecker,
+        userData,
+        ContributionSummary.fromContributions(userData.contribs.loadAll(), RECENT_EDIT_COLUMNS),
+        ContributionSummary.fromContributions(userData.articleContribs.loadAll(), RECENT_EDIT_COLUMNS),
+        groups,
+        withFlaggedEditCount,
+    )
+
+
+def extractFeaturesFromSummaries(
+    criteriaChecker: CriteriaChecker,
+    userData: UserData,
+    contribSummary: ContributionSummary,
+    articleContribSummary: ContributionSummary,
+    groups: Iterable[GroupThresholds] = (REVIEW_THRESHOLDS, AUTOREVIEW_THRESHOLDS),
+    withFlaggedEditCount: bool = False,
+) -> Dict[str, Any]:
+    # The contributions of userData are not used, so they can come from a bounded-memory pass over the history.
+    # withFlaggedEditCount also loads the flagged edit count of users whose content edits are sufficient, a
+    # snapshot needs it for replays with a higher minimumContentEditCount.
+    metadata = userData.metadata
+    params = userData.flaggedRevsUserParams
+    totalContentEdits = criteriaChecker.getTotalContentEdits(params)
+    if withFlaggedEditCount or totalContentEdits < max(thresholds.minimumContentEditCount for thresholds in groups):
+        flaggedEditCount = userData.flaggedEditCount
+    else:
+        flaggedEditCount = UNKNOWN_FLAGGED_EDIT_COUNT
+    return {
+        "registrationTime": toEpoch(userData.registrationTime),
+        "editCount": metadata.editCount,
+        "blocked": metadata.blocked,
+        "isBot": metadata.isBot,
+        "hasReviewRight": "review" in metadata.rights,
+        "hasAutoReviewRight": "autoreview" in metadata.rights,
+        "wasBlockedBefore": userData.wasBlockedBefore,
+        "hadReviewRightsRemovedBefore": userData.hadReviewRightsRemovedBefore,
+        "totalContentEdits": totalContentEdits,
+        "articlePageCount": criteriaChecker.getArticlePageCount(params),
+        "customSummaryCount": criteriaChecker.getCustomSummaryCount(params),
+        "revertedEdits": float(params["revertedEdits"]) if "revertedEdits" in params else np.nan,
+        "flaggedEditCount": flaggedEditCount,
+        "contribCount": contribSummary.count,
+        "articleContribCount": articleContribSummary.count,
+        "spacedEditCount": contribSummary.spacedEditCount,
+        "articleSpacedEditCount": articleContribSummary.spacedEditCount,
+        "recentArticleEditTimestamps": articleContribSummary.newestTimestamps[:RECENT_EDIT_COLUMNS].tolist(),
+    }
+
+
+def loadFeatureTable(
+    criteriaChecker: CriteriaChecker,
+    metadata: Dict[str, UserMetadata],
+    groups: Iterable[GroupThresholds] = (REVIEW_THRESHOLDS, AUTOREVIEW_THRESHOLDS),
+) -> FeatureTable:
+    # A fixed number of batched replica queries for the whole list instead of the requests of the single user
+    # path. The whole contribution history is read, so the caller has to leave out users with many edits.
+    # Nothing is added to the caches of criteriaChecker, they are never refreshed.
+    groups = list(groups)
+    now = datetime.now()
+    existingUsernames = sorted(metadata)
+    allParams = criteriaChecker.loadFlaggedRevsUserParams(existingUsernames)
+    history = criteriaChecker.userHistory.fetch(existingUsernames)
+    summaries = criteriaChecker.summarizeContributionsFromReplica(existingUsernames, RECENT_EDIT_COLUMNS)
+    minimumContentEditCount = max(thresholds.minimumContentEditCount for thresholds in groups)
+    flaggedEditCounts = criteriaChecker.getFlaggedEditCountsFromReplica(
+        username
+        for username in existingUsernames
+        if criteriaChecker.getTotalContentEdits(allParams[username]) < minimumContentEditCount
+    )
+    features = []
+    for username in existingUsernames:
+        userData = criteriaChecker.getUserData(pywikibot.User(criteriaChecker.site, username), now, True)
+        userData.values["metadata"] = metadata[username]
+        userData.values["flaggedRevsUserParams"] = allParams[username]
+        userData.values["eventLogFlags"] = (
+            history[username].wasBlockedBefore,
+            history[username].hadReviewRightsRemovedBefore,
+        )
+        if history[username].registrationTime is not None:
+            userData.values["registrationTime"] = history[username].registrationTime
+        if username in flaggedEditCounts:
+            userData.values["flaggedEditCount"] = flaggedEditCounts[username]
+        contribSummary, articleContribSummary = summaries[username]
+        features.append(
+            (
+                username,
+                extractFeaturesFromSummaries(criteriaChecker, userData, contribSummary, articleContribSummary, groups),
+            )
+        )
+    table = FeatureTable.fromFeatures(features)
+    table.createdAt = now
+    return table
+
+
+def replaceThresholds(thresholds: GroupThresholds, overrides: Iterable[str]) -> GroupThresholds:
+    # overrides are given as name=value, e.g. minimumSpacedEdits=10 or maximumRevertRatio=none
+    fieldTypes = {thresholdField.name: thresholdField.type for thresholdField in dataclasses.fields(GroupThresholds)}
+    changes: Dict[str, Any] = {}
+    for override in overrides:
+        name, separator, value = override.partition("=")
+        if not separator or name not in fieldTypes:
+            raise ValueError(f"Unknown threshold {override}, expected one of {', '.join(fieldTypes)}")
+        # typing.get_args needs Python 3.8
+        fieldArgs = getattr(fieldTypes[name], "__args__", ())
+        valueTypes = [valueType for valueType in fieldArgs if valueType is not type(None)]
+        valueType = valueTypes[0] if valueTypes else fieldTypes[name]
+        if value.lower() == "none" and valueTypes:
+            changes[name] = None
+        elif valueType is bool:
+            changes[name] = value.lower() in ["1", "true", "yes"]
+        else:
+            changes[name] = valueType(value)
+    return dataclasses.replace(thresholds, **changes)
+
+
+def evaluateGroup(
+    table: FeatureTable, thresholds: GroupThresholds, now: Optional[datetime] = None
+) -> Dict[str, np.ndarray]:
+    # same criteria as CriteriaChecker.checkUserEligibleForGroup, one boolean array per criterion
+    if now is None:
+        now = table.createdAt
+    nowEpoch = toEpoch(now) + now.microsecond / 1000000
+    columns = table.columns
+    results: Dict[str, np.ndarray] = {}
+    results["registrationTime"] = columns["registrationTime"] <= nowEpoch - thresholds.minimumAgeInDays * 86400
+    if thresholds.minimumEditCount is not None:
+        results["editCount"] = columns["editCount"] >= thresholds.minimumEditCount
+    results["blockAndBotStatus"] = ~columns["blocked"] & ~columns["isBot"]
+    results["articlePageCount"] = columns["articlePageCount"] >= thresholds.minimumSeparatePages
+    results["customSummaryCount"] = columns["customSummaryCount"] >= thresholds.minimumEditsWithCustomSummary
+    results["eventLog"] = ~columns["wasBlockedBefore"] & ~columns["hadReviewRightsRemovedBefore"]
+    results["contentOrFlaggedEditCount"] = (columns["totalContentEdits"] >= thresholds.minimumContentEditCount) | (
+        columns["flaggedEditCount"] >= thresholds.minimumFlaggedEditCount
+    )
+    if thresholds.minimumRecentArticleEdits is not None and thresholds.minimumRecentArticleEdits > 0:
+        minimumEditCount = thresholds.minimumRecentArticleEdits
+        if minimumEditCount > RECENT_EDIT_COLUMNS:
+            raise ValueError(f"At most {RECENT_EDIT_COLUMNS} recent article edits can be required")
+        nthNewestTimestamps = columns["recentArticleEditTimestamps"][:, minimumEditCount - 1]
+        results["recentArticleEdits"] = (columns["articleContribCount"] >= minimumEditCount) & (
+            nowEpoch - nthNewestTimestamps <= thresholds.recentArticleEditDays * 86400
+        )
+    if thresholds.spacedEditsInArticlesOnly:
+        results["spacedEdits"] = (columns["articleContribCount"] > 0) & (
+            columns["articleSpacedEditCount"] >= thresholds.minimumSpacedEdits
+        )
+    else:
+        results["spacedEdits"] = (columns["contribCount"] > 0) & (
+            columns["spacedEditCount"] >= thresholds.minimumSpacedEdits
+        )
+    if thresholds.maximumRevertRatio is not None:
+        revertedEdits = columns["revertedEdits"]
+        with np.errstate(invalid="ignore"):
+            revertRatios = np.divide(
+                revertedEdits,
+                columns["contribCount"],
+                out=np.full(len(table), np.inf),
+                where=columns["contribCount"] > 0,
+            )
+            results["revertRatio"] = np.isnan(revertedEdits) | ~(revertRatios > thresholds.maximumRevertRatio)
+    eligible = np.ones(len(table), dtype=np.bool_)
+    for met in results.values():
+        eligible &= met
+    results["eligible"] = eligible
+    return results
+
+
+def explainUser(
+    criteriaChecker: CriteriaChecker, table: FeatureTable, index: int, thresholds: GroupThresholds
+) -> List[CriteriaCheck]:
+    # the explanatory texts are only built for the users that are reported or requested
+    columns = table.columns
+    criteriaChecks: List[CriteriaCheck] = []
+    criteriaChecks += criteriaChecker.checkRegistrationTime(
+        pywikibot.Timestamp.utcfromtimestamp(int(columns["registrationTime"][index])), thresholds.minimumAgeInDays
+    )
+    if thresholds.minimumEditCount is not None:
+        criteriaChecks += criteriaChecker.checkEditCount(int(columns["editCount"][index]), thresholds.minimumEditCount)
+    criteriaChecks += criteriaChecker.checkBlockAndBotStatus(
+        bool(columns["blocked"][index]), bool(columns["isBot"][index])
+    )
+    criteriaChecks += criteriaChecker.checkArticlePageCount(
+        int(columns["articlePageCount"][index]), thresholds.minimumSeparatePages
+    )
+    criteriaChecks += criteriaChecker.checkCustomSummaryCount(
+        int(columns["customSummaryCount"][index]), thresholds.minimumEditsWithCustomSummary
+    )
+    criteriaChecks += criteriaChecker.checkEventLogFlags(
+        bool(columns["wasBlockedBefore"][index]), bool(columns["hadReviewRightsRemovedBefore"][index])
+    )
+    totalContentEdits = int(columns["totalContentEdits"][index])
+    flaggedEditCount = max(int(columns["flaggedEditCount"][index]), 0)
+    criteriaChecks += criteriaChecker.checkContentOrFlaggedEditCount(
+        totalContentEdits,
+        flaggedEditCount if totalContentEdits < thresholds.minimumContentEditCount else 0,
+        thresholds.minimumContentEditCount,
+        thresholds.minimumFlaggedEditCount,
+    )
+    if thresholds.minimumRecentArticleEdits is not None:
+        minimumEditCount = thresholds.minimumRecentArticleEdits
+        if 0 < minimumEditCount <= columns["articleContribCount"][index]:
+            nthNewestTimestamp: Optional[int] = int(
+                columns["recentArticleEditTimestamps"][index, minimumEditCount - 1]
+            )
+        else:
+            nthNewestTimestamp = None
+        criteriaChecks += criteriaChecker.checkRecentArticleEdits(
+            nthNewestTimestamp, minimumEditCount, thresholds.recentArticleEditDays
+        )
+    if thresholds.spacedEditsInArticlesOnly:
+        contribCount, spacedEditCount = columns["articleContribCount"][index], columns["articleSpacedEditCount"][index]
+    else:
+        contribCount, spacedEditCount = columns["contribCount"][index], columns["spacedEditCount"][index]
+    criteriaChecks += criteriaChecker.checkSpacedEditCount(
+        int(spacedEditCount) if contribCount > 0 else None, thresholds.minimumSpacedEdits
+    )
+    if thresholds.maximumRevertRatio is not None:
+        revertedEdits = float(columns["revertedEdits"][index])
+        criteriaChecks += criteriaChecker.checkRevertRatio(
+            None if np.isnan(revertedEdits) else revertedEdits,
+            int(columns["contribCount"][index]),
+            thresholds.maximumRevertRatio,
+        )
+    return criteriaChecks
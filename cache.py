@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    def __init__(self, maxSize: int, ttl: float) -> None:
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+
+class InFlightCall:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, InFlightCall] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: float) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            isLeader = call is None
+            if call is None:
+                call = InFlightCall()
+                self.calls[key] = call
+        if isLeader:
+            try:
+                call.result = fn()
+            except BaseException as e:  # pylint: disable=broad-except
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        elif not call.done.wait(timeout):
+            raise TimeoutError(f"No result for {key} after {timeout}s")
+        if call.error is not None:
+            raise call.error
+        return call.result
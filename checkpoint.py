@@ -0,0 +1,62 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class RunCheckpoint:
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_runs (runKey TEXT PRIMARY KEY, usernames TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_verdicts ("
+                " runKey TEXT NOT NULL,"
+                " username TEXT NOT NULL,"
+                " eligibleForReview INTEGER NOT NULL,"
+                " eligibleForAutoReview INTEGER NOT NULL,"
+                " PRIMARY KEY (runKey, username))"
+            )
+
+    def start(self, runKey: str, usernames: List[str]) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM checkpoint_verdicts WHERE runKey=?", (runKey,))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoint_runs VALUES (?, ?)", (runKey, json.dumps(usernames))
+            )
+
+    def getUsernames(self, runKey: str) -> Optional[List[str]]:
+        with self.lock:
+            row = self.connection.execute("SELECT usernames FROM checkpoint_runs WHERE runKey=?", (runKey,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def getVerdicts(self, runKey: str) -> Dict[str, Tuple[bool, bool]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT username, eligibleForReview, eligibleForAutoReview FROM checkpoint_verdicts WHERE runKey=?",
+                (runKey,),
+            ).fetchall()
+        return {username: (bool(review), bool(autoReview)) for username, review, autoReview in rows}
+
+    def addVerdicts(self, runKey: str, verdicts: Iterable[Tuple[str, bool, bool]]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO checkpoint_verdicts VALUES (?, ?, ?, ?)",
+                [(runKey, username, review, autoReview) for username, review, autoReview in verdicts],
+            )
+
+    def clear(self, runKey: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM checkpoint_verdicts WHERE runKey=?", (runKey,))
+            self.connection.execute("DELETE FROM checkpoint_runs WHERE runKey=?", (runKey,))
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from itertools import repeat
+from typing import Dict, List, Optional, Tuple
+
+import pywikibot
+
+from contributions import Contributions, fetchContributions, toEpoch
+
+
+class ContributionStore:
+    def __init__(
+        self, path: str, maxContributions: int = 10000000, maxIdleDays: int = 180, maxSyncAgeDays: int = 7
+    ) -> None:
+        self.maxContributions = maxContributions
+        self.maxIdleDays = maxIdleDays
+        self.maxSyncAgeDays = maxSyncAgeDays
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS contributions ("
+                " username TEXT NOT NULL,"
+                " stream TEXT NOT NULL,"
+                " revid INTEGER NOT NULL,"
+                " namespace INTEGER NOT NULL,"
+                " timestamp INTEGER NOT NULL,"
+                " PRIMARY KEY (username, stream, revid))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS contributions_by_time ON contributions (username, stream, timestamp)"
+            )
+            # complete: the oldest contribution of the stream is stored
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS contribution_streams ("
+                " username TEXT NOT NULL,"
+                " stream TEXT NOT NULL,"
+                " complete INTEGER NOT NULL,"
+                " PRIMARY KEY (username, stream))"
+            )
+            # syncedAt: the time the newest contributions of the stream were fetched from scratch
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS contribution_syncs ("
+                " username TEXT NOT NULL,"
+                " stream TEXT NOT NULL,"
+                " syncedAt INTEGER NOT NULL,"
+                " PRIMARY KEY (username, stream))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS contribution_users (username TEXT PRIMARY KEY, lastSeen INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS flagged_revisions (revid INTEGER PRIMARY KEY, flagged INTEGER NOT NULL)"
+            )
+
+    @staticmethod
+    def getStreamName(namespaces: Optional[List[int]]) -> str:
+        return "|".join(str(int(ns)) for ns in sorted(namespaces)) if namespaces is not None else "*"
+
+    def insertContributions(self, username: str, stream: str, contribs: Contributions) -> int:
+        return self.connection.executemany(
+            "INSERT OR IGNORE INTO contributions VALUES (?, ?, ?, ?, ?)",
+            zip(repeat(username), repeat(stream), contribs.revids, contribs.namespaces, contribs.timestamps),
+        ).rowcount
+
+    def replaceContributions(self, username: str, stream: str, contribs: Contributions, complete: bool) -> None:
+        self.connection.execute("DELETE FROM contributions WHERE username=? AND stream=?", (username, stream))
+        self.insertContributions(username, stream, contribs)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO contribution_streams VALUES (?, ?, ?)", (username, stream, complete)
+        )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO contribution_syncs VALUES (?, ?, ?)", (username, stream, int(time.time()))
+        )
+
+    def isSyncExpired(self, username: str, stream: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT syncedAt FROM contribution_syncs WHERE username=? AND stream=?", (username, stream)
+            ).fetchone()
+        return row is None or row[0] < time.time() - self.maxSyncAgeDays * 86400
+
+    def syncNewerContributions(
+        self, user: pywikibot.User, namespaces: Optional[List[int]], stream: str, total: int
+    ) -> None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MAX(timestamp) FROM contributions WHERE username=? AND stream=?", (user.username, stream)
+            ).fetchone()
+        highWaterMark = row[0]
+        # Stored contributions are never checked again, so deleted and hidden revisions stay until the stream
+        # is fetched from scratch after maxSyncAgeDays.
+        if highWaterMark is None or self.isSyncExpired(user.username, stream):
+            contribs = fetchContributions(user, namespaces, total)
+            with self.lock, self.connection:
+                self.replaceContributions(user.username, stream, contribs, len(contribs) < total)
+            return
+
+        contribs = fetchContributions(
+            user, namespaces, total, end=pywikibot.Timestamp.utcfromtimestamp(highWaterMark)
+        )
+        with self.lock, self.connection:
+            if len(contribs) >= total and contribs.timestamps[-1] > highWaterMark:
+                # too many new contributions, the stored ones are no longer contiguous with them
+                self.replaceContributions(user.username, stream, contribs, False)
+            else:
+                self.insertContributions(user.username, stream, contribs)
+
+    def syncOlderContributions(
+        self, user: pywikibot.User, namespaces: Optional[List[int]], stream: str, total: int
+    ) -> bool:
+        # returns whether older contributions were stored, the sync gets stuck when more than total contributions
+        # have the timestamp of the oldest stored one
+        with self.lock:
+            oldest = self.getOldestContribution(user.username, stream)
+        contribs = fetchContributions(
+            user, namespaces, total, start=pywikibot.Timestamp.utcfromtimestamp(oldest[0])
+        )
+        with self.lock, self.connection:
+            insertedCount = self.insertContributions(user.username, stream, contribs)
+            if len(contribs) < total:
+                self.connection.execute(
+                    "UPDATE contribution_streams SET complete=1 WHERE username=? AND stream=?",
+                    (user.username, stream),
+                )
+            return insertedCount > 0 and self.getOldestContribution(user.username, stream) != oldest
+
+    def getOldestContribution(self, username: str, stream: str) -> Tuple[int, int]:
+        return self.connection.execute(
+            "SELECT timestamp, revid FROM contributions WHERE username=? AND stream=?"
+            " ORDER BY timestamp, revid LIMIT 1",
+            (username, stream),
+        ).fetchone()
+
+    def readContributions(self, username: str, stream: str, start: datetime, total: int) -> Contributions:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT revid, namespace, timestamp FROM contributions"
+                " WHERE username=? AND stream=? AND timestamp<=?"
+                " ORDER BY timestamp DESC, revid DESC LIMIT ?",
+                (username, stream, toEpoch(start), total),
+            ).fetchall()
+        contribs = Contributions()
+        for revid, namespace, timestamp in rows:
+            contribs.append(revid, namespace, timestamp)
+        return contribs
+
+    def isComplete(self, username: str, stream: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT complete FROM contribution_streams WHERE username=? AND stream=?", (username, stream)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def getContributions(
+        self,
+        user: pywikibot.User,
+        namespaces: Optional[List[int]],
+        start: datetime,
+        total: int,
+        streamPageSize: Optional[int] = None,
+    ) -> Contributions:
+        # Returns the same contributions as user.contributions(total=total, start=start, namespaces=namespaces),
+        # only fetching those that are newer than the stored ones (or older if more are needed). Revisions that
+        # were deleted or hidden after they were stored are still returned for up to maxSyncAgeDays.
+        # With a streamPageSize older contributions are only read and synced a page at a time when they are needed.
+        stream = self.getStreamName(namespaces)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO contribution_users VALUES (?, ?)", (user.username, int(time.time()))
+            )
+        syncTotal = total if streamPageSize is None else min(total, streamPageSize)
+        self.syncNewerContributions(user, namespaces, stream, syncTotal)
+        contribs = StoredContributionStream(self, user, namespaces, stream, start, total, syncTotal)
+        if streamPageSize is None:
+            return contribs.loadAll()
+        return contribs
+
+    def getFlaggedStatus(self, revids: List[int]) -> Dict[int, bool]:
+        status = {}
+        with self.lock:
+            for i in range(0, len(revids), 500):
+                chunk = revids[i : i + 500]
+                rows = self.connection.execute(
+                    f"SELECT revid, flagged FROM flagged_revisions WHERE revid IN ({','.join(['?'] * len(chunk))})",
+                    chunk,
+                )
+                status.update({revid: bool(flagged) for revid, flagged in rows})
+        return status
+
+    def setFlaggedStatus(self, status: Dict[int, bool]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO flagged_revisions VALUES (?, ?)", list(status.items())
+            )
+
+    def evict(self) -> None:
+        idleSince = int(time.time()) - self.maxIdleDays * 86400
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT contribution_users.username, lastSeen, COUNT(revid) FROM contribution_users"
+                " LEFT JOIN contributions ON contributions.username=contribution_users.username"
+                " GROUP BY contribution_users.username ORDER BY lastSeen"
+            ).fetchall()
+            contributionCount = sum(row[2] for row in rows)
+            # users not seen for a long time and then the least recently seen ones until the store is small enough
+            evictedUsers = []
+            for username, lastSeen, userContributionCount in rows:
+                if lastSeen >= idleSince and contributionCount <= self.maxContributions:
+                    break
+                evictedUsers.append(username)
+                contributionCount -= userContributionCount
+            for username in evictedUsers:
+                self.connection.execute("DELETE FROM contributions WHERE username=?", (username,))
+                self.connection.execute("DELETE FROM contribution_streams WHERE username=?", (username,))
+                self.connection.execute("DELETE FROM contribution_syncs WHERE username=?", (username,))
+                self.connection.execute("DELETE FROM contribution_users WHERE username=?", (username,))
+            self.connection.execute(
+                "DELETE FROM flagged_revisions WHERE revid NOT IN (SELECT revid FROM contributions)"
+            )
+
+
+class StoredContributionStream(Contributions):
+    # only reads further contributions from the store, and syncs older ones, when they are needed
+
+    def __init__(
+        self,
+        store: ContributionStore,
+        user: pywikibot.User,
+        streamNamespaces: Optional[List[int]],
+        stream: str,
+        start: datetime,
+        total: int,
+        syncTotal: int,
+    ) -> None:
+        super().__init__()
+        self.store = store
+        self.user = user
+        self.streamNamespaces = streamNamespaces
+        self.stream = stream
+        self.start = start
+        self.total = total
+        self.syncTotal = syncTotal
+        self.complete = False
+
+    def isComplete(self) -> bool:
+        return self.complete
+
+    def ensure(self, count: int) -> bool:
+        if len(self) < count and not self.complete:
+            readTotal = min(self.total, max(count, len(self) + self.syncTotal))
+            contribs = self.store.readContributions(self.user.username, self.stream, self.start, readTotal)
+            while (
+                len(contribs) < readTotal
+                and not self.store.isComplete(self.user.username, self.stream)
+                and self.store.syncOlderContributions(self.user, self.streamNamespaces, self.stream, self.syncTotal)
+            ):
+                contribs = self.store.readContributions(self.user.username, self.stream, self.start, readTotal)
+            self.revids, self.namespaces, self.timestamps = contribs.revids, contribs.namespaces, contribs.timestamps
+            self.complete = len(contribs) < readTotal or readTotal == self.total
+        return len(self) >= count
+
+    def loadAll(self) -> "Contributions":
+        self.ensure(self.total)
+        return self
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import calendar
+import sys
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import pywikibot
+
+
+class Contribution(NamedTuple):
+    revid: int
+    namespace: int
+    timestamp: pywikibot.Timestamp
+
+
+def toEpoch(timestamp: datetime) -> int:
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def parseReplicaTimestamp(timestamp: bytes) -> int:
+    # b"20200106123456"
+    return calendar.timegm(
+        (
+            int(timestamp[0:4]),
+            int(timestamp[4:6]),
+            int(timestamp[6:8]),
+            int(timestamp[8:10]),
+            int(timestamp[10:12]),
+            int(timestamp[12:14]),
+        )
+    )
+
+
+def parseApiTimestamp(timestamp: str) -> int:
+    # "2020-01-06T12:34:56Z", much faster than going through pywikibot.Timestamp
+    return calendar.timegm(
+        (
+            int(timestamp[0:4]),
+            int(timestamp[5:7]),
+            int(timestamp[8:10]),
+            int(timestamp[11:13]),
+            int(timestamp[14:16]),
+            int(timestamp[17:19]),
+        )
+    )
+
+
+class Contributions:
+    # newest first, one column per field, timestamps in seconds since the epoch
+
+    def __init__(self) -> None:
+        self.revids = array("q")
+        self.namespaces = array("q")
+        self.timestamps = array("q")
+
+    def append(self, revid: int, namespace: int, timestamp: int) -> None:
+        self.revids.append(revid)
+        self.namespaces.append(namespace)
+        self.timestamps.append(timestamp)
+
+    def __len__(self) -> int:
+        return len(self.revids)
+
+    def __getitem__(self, index: int) -> Contribution:
+        return Contribution(
+            self.revids[index],
+            self.namespaces[index],
+            pywikibot.Timestamp.utcfromtimestamp(self.timestamps[index]),
+        )
+
+    def __iter__(self) -> Iterator[Contribution]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def isComplete(self) -> bool:
+        return True
+
+    def ensure(self, count: int) -> bool:
+        return len(self) >= count
+
+    def loadAll(self) -> "Contributions":
+        return self
+
+
+class ContributionStream(Contributions):
+    # only fetches further contributions from the API when they are needed
+
+    def __init__(self, apiContribs: Iterator[Dict[str, Any]]) -> None:
+        super().__init__()
+        self.apiContribs = apiContribs
+        self.complete = False
+
+    def isComplete(self) -> bool:
+        return self.complete
+
+    def ensure(self, count: int) -> bool:
+        while len(self) < count and not self.complete:
+            contrib = next(self.apiContribs, None)
+            if contrib is None:
+                self.complete = True
+            else:
+                self.append(contrib["revid"], contrib["ns"], parseApiTimestamp(contrib["timestamp"]))
+        return len(self) >= count
+
+    def loadAll(self) -> "Contributions":
+        self.ensure(sys.maxsize)
+        return self
+
+
+def fetchContributions(
+    user: pywikibot.User,
+    namespaces: Optional[List[int]],
+    total: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    streamPageSize: Optional[int] = None,
+) -> Contributions:
+    # The raw API results are read directly instead of creating a Page and Timestamp for each contribution.
+    # With a streamPageSize only as many pages as needed are fetched, otherwise all contributions are loaded.
+    apiContribs = user.site.usercontribs(user=user.username, namespaces=namespaces, start=start, end=end, total=total)
+    if streamPageSize is None:
+        return ContributionStream(iter(apiContribs)).loadAll()
+    apiContribs.set_query_increment(streamPageSize)
+    return ContributionStream(iter(apiContribs))
+
+
+class ContributionSummary:
+    # bounded memory: counts all contributions but only keeps the timestamps of the newest ones
+
+    def __init__(self, keepNewest: int) -> None:
+        self.keepNewest = keepNewest
+        self.count = 0
+        self.spacedEditCount = 0
+        self.lastSpacedTimestamp: Optional[int] = None
+        self.newestTimestamps = array("q")
+
+    def add(self, timestamp: int) -> None:
+        # newest first, same rule as CriteriaChecker.getSpacedEditCount
+        if self.count < self.keepNewest:
+            self.newestTimestamps.append(timestamp)
+        if self.lastSpacedTimestamp is None:
+            self.lastSpacedTimestamp = timestamp
+        elif self.lastSpacedTimestamp - timestamp > 3 * 86400:
+            self.spacedEditCount += 1
+            self.lastSpacedTimestamp = timestamp
+        self.count += 1
+
+    @staticmethod
+    def fromContributions(contribs: Contributions, keepNewest: int) -> "ContributionSummary":
+        summary = ContributionSummary(keepNewest)
+        for timestamp in contribs.timestamps:
+            summary.add(timestamp)
+        return summary
+
+
+def summarizeContributions(
+    user: pywikibot.User, keepNewest: int, total: Optional[int] = None, start: Optional[datetime] = None
+) -> Tuple[ContributionSummary, ContributionSummary]:
+    # a single pass over the whole history, returns the summaries of all and of the article contributions
+    contribSummary = ContributionSummary(keepNewest)
+    articleContribSummary = ContributionSummary(keepNewest)
+    for contrib in user.site.usercontribs(user=user.username, start=start, total=total):
+        timestamp = parseApiTimestamp(contrib["timestamp"])
+        contribSummary.add(timestamp)
+        if contrib["ns"] == 0:
+            articleContribSummary.add(timestamp)
+    return (contribSummary, articleContribSummary)
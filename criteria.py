@@ -6,16 +6,32 @@
 
 from __future__ import unicode_literals
 
-import re
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, cast
+from typing import Any, Callable, Deque, Dict, Generator, Iterable, Iterator, List, Optional, Set, Tuple, cast
 
 import pytz
 import pywikibot
-from pywikibot.data import mysql
 from pywikibot.site import Namespace
 
+from contribstore import ContributionStore
+from contributions import (
+    ContributionSummary,
+    Contributions,
+    fetchContributions,
+    parseReplicaTimestamp,
+    toEpoch,
+)
+from replica import ReplicaConnectionPool
+from userhistory import UserHistoryCache, isReviewRightsRemoval
+from usermetadata import UserMetadata, UserMetadataCache
+
 
 @dataclass
 class CriteriaCheck:
@@ -23,69 +39,251 @@ class CriteriaCheck:
     text: str
 
 
-@dataclass
+@dataclass(frozen=True)
+class GroupThresholds:
+    minimumAgeInDays: int
+    minimumContentEditCount: int
+    minimumFlaggedEditCount: int
+    minimumSpacedEdits: int
+    spacedEditsInArticlesOnly: bool
+    minimumSeparatePages: int
+    minimumEditsWithCustomSummary: int
+    minimumEditCount: Optional[int] = None
+    minimumRecentArticleEdits: Optional[int] = None
+    recentArticleEditDays: int = 30
+    maximumRevertRatio: Optional[float] = None
+
+
+REVIEW_THRESHOLDS = GroupThresholds(
+    minimumAgeInDays=60,
+    minimumEditCount=300,
+    minimumContentEditCount=300,
+    minimumFlaggedEditCount=200,
+    minimumSpacedEdits=15,
+    spacedEditsInArticlesOnly=False,
+    minimumSeparatePages=14,
+    minimumRecentArticleEdits=5,
+    recentArticleEditDays=30,
+    minimumEditsWithCustomSummary=30,
+    maximumRevertRatio=0.03,
+)
+
+AUTOREVIEW_THRESHOLDS = GroupThresholds(
+    minimumAgeInDays=30,
+    minimumContentEditCount=150,
+    minimumFlaggedEditCount=50,
+    minimumSpacedEdits=7,
+    spacedEditsInArticlesOnly=True,
+    minimumSeparatePages=8,
+    minimumEditsWithCustomSummary=20,
+)
+
+
 class UserData:
-    user: pywikibot.User
-    editCount: int
-    contribs: List[Any]
-    articleContribs: List[Any]
-    flaggedEditCount: int
-    logEntries: List[Any]
-    registrationTime: datetime
-    flaggedRevsUserParams: Dict[str, str]
+    def __init__(self, user: pywikibot.User, loaders: Dict[str, Callable[[], Any]]) -> None:
+        self.user = user
+        self.loaders = loaders
+        self.values: Dict[str, Any] = {}
+        self.locks = {name: threading.Lock() for name in loaders}
+
+    def load(self, name: str) -> Any:
+        if name not in self.values:
+            with self.locks[name]:
+                if name not in self.values:
+                    self.values[name] = self.loaders[name]()
+        return self.values[name]
+
+    @property
+    def metadata(self) -> UserMetadata:
+        return cast(UserMetadata, self.load("metadata"))
+
+    @property
+    def editCount(self) -> int:
+        return self.metadata.editCount
+
+    @property
+    def contribs(self) -> Contributions:
+        return cast(Contributions, self.load("contribs"))
+
+    @property
+    def articleContribs(self) -> Contributions:
+        return cast(Contributions, self.load("articleContribs"))
+
+    @property
+    def flaggedEditCount(self) -> int:
+        return cast(int, self.load("flaggedEditCount"))
+
+    @property
+    def wasBlockedBefore(self) -> bool:
+        return cast(Tuple[bool, bool], self.load("eventLogFlags"))[0]
+
+    @property
+    def hadReviewRightsRemovedBefore(self) -> bool:
+        return cast(Tuple[bool, bool], self.load("eventLogFlags"))[1]
+
+    @property
+    def registrationTime(self) -> datetime:
+        return cast(datetime, self.load("registrationTime"))
+
+    @property
+    def flaggedRevsUserParams(self) -> Dict[str, str]:
+        return cast(Dict[str, str], self.load("flaggedRevsUserParams"))
+
+
+FLAGGED_COUNT_BACKENDS = ["api", "replica"]
+
+
+class UserDataFetchError(Exception):
+    def __init__(self, errors: Dict[str, BaseException]) -> None:
+        super().__init__(
+            "Fetching user data failed: " + ", ".join(f"{name} ({error!r})" for name, error in errors.items())
+        )
+        self.errors = errors
 
 
 class CriteriaChecker:
-    def __init__(self, site: pywikibot.site.BaseSite) -> None:
+    def __init__(
+        self,
+        site: pywikibot.site.BaseSite,
+        fetchWorkers: int = 0,
+        defaultFetchTimeout: float = 60,
+        flaggedCountBackend: str = "api",
+        replicaPoolSize: int = 4,
+        contributionStore: Optional[ContributionStore] = None,
+        flaggedStatusRequests: int = 4,
+    ) -> None:
+        if flaggedCountBackend not in FLAGGED_COUNT_BACKENDS:
+            raise ValueError(f"Unknown flagged edit count backend {flaggedCountBackend}")
         self.site = site
+        self.flaggedCountBackend = flaggedCountBackend
+        self.contributionStore = contributionStore
+        self.streamPageSize = 500
+        self.fetchExecutor = ThreadPoolExecutor(max_workers=fetchWorkers) if fetchWorkers > 1 else None
+        # shared by all users, limits the flagged status requests that run at the same time
+        self.flaggedStatusRequests = flaggedStatusRequests
+        self.flaggedStatusExecutor = ThreadPoolExecutor(max_workers=flaggedStatusRequests)
+        self.defaultFetchTimeout = defaultFetchTimeout
+        self.fetchTimeouts: Dict[str, float] = {"metadata": 15, "registrationTime": 15, "flaggedRevsUserParams": 15}
         self.timezone = pytz.timezone("Europe/Berlin")
+        self.replica = ReplicaConnectionPool(site.dbName(), size=replicaPoolSize)
+        self.replicaChunkSize = 1000
+        self.flaggedRevsUserParams: Dict[str, Dict[str, str]] = {}
+        self.userMetadata = UserMetadataCache(site)
+        self.userHistory = UserHistoryCache(self.replica, self.replicaChunkSize)
+
+    @staticmethod
+    def parseFlaggedRevsUserParams(rawParams: str) -> Dict[str, str]:
+        params = {}
+        pos = 0
+        end = len(rawParams)
+        while pos < end:
+            lineEnd = rawParams.find("\n", pos)
+            if lineEnd == -1:
+                lineEnd = end
+            separator = rawParams.find("=", pos, lineEnd)
+            if separator == -1:
+                raise Exception(f"Unexpected flaggedRevs user param format in line {rawParams[pos:lineEnd]}")
+            params[rawParams[pos:separator]] = rawParams[separator + 1 : lineEnd]
+            pos = lineEnd + 1
+        return params
+
+    @staticmethod
+    def getArticlePageCount(flaggedRevsUserParams: Dict[str, str]) -> int:
+        uniqueContentPages = (
+            flaggedRevsUserParams["uniqueContentPages"] if "uniqueContentPages" in flaggedRevsUserParams else ""
+        )
+        return 0 if not uniqueContentPages else uniqueContentPages.count(",") + 1
+
+    @staticmethod
+    def getTotalContentEdits(flaggedRevsUserParams: Dict[str, str]) -> int:
+        return (
+            int(flaggedRevsUserParams["totalContentEdits"]) if "totalContentEdits" in flaggedRevsUserParams else 0
+        )
+
+    @staticmethod
+    def getCustomSummaryCount(flaggedRevsUserParams: Dict[str, str]) -> int:
+        return int(flaggedRevsUserParams["editComments"]) if "editComments" in flaggedRevsUserParams else 0
 
     def getFlaggedRevsUserParams(self, user: pywikibot.User) -> Dict[str, str]:
+        if user.username in self.flaggedRevsUserParams:
+            return self.flaggedRevsUserParams[user.username]
         res = list(
-            mysql.mysql_query(
+            self.replica.query(
                 "SELECT frp_user_params from flaggedrevs_promote,user where user_id=frp_user_id and user_name=%s limit 1",
-                dbname="dewiki",
                 params=user.username,
             )
         )
-        params = {}
-        if res:
-            rawParams = re.split("\n", res[0][0].decode())
-            for rawParam in rawParams:
-                match = re.match("(.*)=(.*)", rawParam)
-                if not match:
-                    raise Exception(f"Unexpected flaggedRevs user param format in line {rawParam}")
-                params[match.group(1)] = match.group(2)
-        return params
-
-    def getFlaggedRevisionCount(self, contribs) -> int:
-        revs = ""
-        for contrib in contribs:
-            if contrib["ns"] == 0 or contrib["ns"] == Namespace.TEMPLATE:
-                if len(revs) != 0:
-                    revs += "|"
-                revs += str(contrib["revid"])
-        flaggedEdits = 0
-        if len(revs) != 0:
-            revisionsRequest = pywikibot.data.api.Request(
-                site=self.site,
-                parameters={
-                    "action": "query",
-                    "format": "json",
-                    "prop": "revisions",
-                    "rvprop": "flagged|ids",
-                    "revids": revs,
-                },
+        return self.parseFlaggedRevsUserParams(res[0][0].decode()) if res else {}
+
+    def loadFlaggedRevsUserParams(self, usernames: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        usernames = sorted(set(usernames))
+        allParams: Dict[str, Dict[str, str]] = {username: {} for username in usernames}
+        for i in range(0, len(usernames), self.replicaChunkSize):
+            chunk = usernames[i : i + self.replicaChunkSize]
+            placeholders = ",".join(["%s"] * len(chunk))
+            res = self.replica.query(
+                "SELECT user_name, frp_user_params from flaggedrevs_promote,user"
+                f" where user_id=frp_user_id and user_name in ({placeholders})",
+                params=tuple(chunk),
             )
-            data = revisionsRequest.submit()
-            pages = data["query"]["pages"]
-            for page in pages:
-                for revision in pages[page]["revisions"]:
-                    if "flagged" in revision:
-                        flaggedEdits += 1
-        return flaggedEdits
+            for rawUsername, rawParams in res:
+                allParams[rawUsername.decode()] = self.parseFlaggedRevsUserParams(rawParams.decode())
+        return allParams
+
+    def getGroupsWithRight(self, right: str) -> Set[str]:
+        return {group["name"] for group in self.site.siteinfo.get("usergroups") if right in group["rights"]}
+
+    def prefilterCandidates(self, usernames: Iterable[str]) -> Set[str]:
+        # Drops users that can neither be eligible for the review nor for the autoreview group (or already
+        # have review rights) using only the replica. The flaggedrevs_promote params of the remaining users are
+        # cached for getFlaggedRevsUserParams.
+        thresholds = [REVIEW_THRESHOLDS, AUTOREVIEW_THRESHOLDS]
+        minimumAgeInDays = min(t.minimumAgeInDays for t in thresholds)
+        # flagged and content edits can not exceed the total edit count
+        minimumEditCount = min(min(t.minimumContentEditCount, t.minimumFlaggedEditCount) for t in thresholds)
+        minimumSeparatePages = min(t.minimumSeparatePages for t in thresholds)
+        minimumEditsWithCustomSummary = min(t.minimumEditsWithCustomSummary for t in thresholds)
+        excludedGroups = sorted(self.getGroupsWithRight("review") | {"bot"})
+
+        now = datetime.now()
+        nowTimestamp = now.strftime("%Y%m%d%H%M%S")
+        newestRegistration = (now - timedelta(days=minimumAgeInDays)).strftime("%Y%m%d%H%M%S")
+        usernames = sorted(set(usernames))
+        remaining = set()
+        for i in range(0, len(usernames), self.replicaChunkSize):
+            chunk = usernames[i : i + self.replicaChunkSize]
+            res = self.replica.query(
+                "SELECT user_name, user_editcount, user_registration, frp_user_params,"
+                " EXISTS(SELECT 1 FROM user_groups WHERE ug_user=user_id"
+                f" AND ug_group IN ({','.join(['%s'] * len(excludedGroups))})"
+                " AND (ug_expiry IS NULL OR ug_expiry > %s)),"
+                " EXISTS(SELECT 1 FROM block_target JOIN block ON bl_target=bt_id"
+                " WHERE bt_user=user_id AND bl_expiry > %s)"
+                " FROM user LEFT JOIN flaggedrevs_promote ON frp_user_id=user_id"
+                f" WHERE user_name IN ({','.join(['%s'] * len(chunk))})",
+                params=(*excludedGroups, nowTimestamp, nowTimestamp, *chunk),
+            )
+            for rawUsername, editCount, rawRegistration, rawParams, inExcludedGroup, blocked in res:
+                username = rawUsername.decode()
+                params = self.parseFlaggedRevsUserParams(rawParams.decode()) if rawParams else {}
+                if inExcludedGroup or blocked:
+                    continue
+                if rawRegistration and rawRegistration.decode() > newestRegistration:
+                    continue
+                if editCount is not None and editCount < minimumEditCount:
+                    continue
+                if self.getArticlePageCount(params) < minimumSeparatePages:
+                    continue
+                if self.getCustomSummaryCount(params) < minimumEditsWithCustomSummary:
+                    continue
+                self.flaggedRevsUserParams[username] = params
+                remaining.add(username)
+        return remaining
 
-    def getFlaggedEditCount(self, user: pywikibot.User, exactResults: bool) -> int:
+    def getFlaggedEditContribLimit(self) -> int:
+        return 5000 if self.site.has_right("apihighlimits") else 500
+
+    def getFlaggedEditChunkCountsFromApi(self, user: pywikibot.User, readAhead: bool = True) -> Iterator[int]:
         (_, _, lastEditTimestamp, _) = user.last_edit
         contribsRequest = pywikibot.data.api.Request(
             site=self.site,
@@ -101,31 +299,263 @@ class CriteriaChecker:
         )
         data = contribsRequest.submit()
         contribs = data["query"]["usercontribs"]
-        flaggedEdits = self.getFlaggedRevisionCount(contribs[:500])
-        contribsRest = contribs[500:]
-        while contribsRest and (exactResults or flaggedEdits < 200):
-            contribsPart = contribsRest[:500]
-            contribsRest = contribsRest[500:]
-            flaggedEdits += self.getFlaggedRevisionCount(contribsPart)
+        revidChunks = [
+            [contrib["revid"] for contrib in contribs[i : i + 500] if contrib["ns"] in [0, Namespace.TEMPLATE]]
+            for i in range(0, len(contribs), 500)
+        ]
+        chunkStatus = self.iterFlaggedRevisionStatus(revidChunks, readAhead)
+        try:
+            for status in chunkStatus:
+                yield sum(1 for flagged in status.values() if flagged)
+        finally:
+            chunkStatus.close()
+
+    def getFlaggedEditChunkCountsFromReplica(self, user: pywikibot.User) -> Iterator[int]:
+        # same window and chunking as the usercontribs based variant, counted in a single query
+        res = self.replica.query(
+            "SELECT FLOOR((contribNumber - 1) / 500), SUM(page_namespace IN (0, 10) AND fr_rev_id IS NOT NULL)"
+            " FROM (SELECT page_namespace, fr_rev_id,"
+            " ROW_NUMBER() OVER (ORDER BY rev_timestamp DESC, rev_id DESC) AS contribNumber"
+            " FROM revision_userindex"
+            " JOIN actor_revision ON actor_id=rev_actor"
+            " JOIN page ON page_id=rev_page"
+            " LEFT JOIN flaggedrevs ON fr_rev_id=rev_id"
+            " WHERE actor_name=%s AND page_namespace IN (0, 6, 10, 14, 828) AND rev_deleted & 4 = 0"
+            " AND rev_timestamp <= (SELECT DATE_FORMAT("
+            "STR_TO_DATE(MAX(rev_timestamp), '%%Y%%m%%d%%H%%i%%s') - INTERVAL 2 DAY, '%%Y%%m%%d%%H%%i%%s')"
+            " FROM revision_userindex JOIN actor_revision ON actor_id=rev_actor"
+            " WHERE actor_name=%s AND rev_deleted & 4 = 0)"
+            " ORDER BY rev_timestamp DESC, rev_id DESC LIMIT %s) AS contribs"
+            " GROUP BY 1 ORDER BY 1",
+            params=(user.username, user.username, self.getFlaggedEditContribLimit()),
+        )
+        for _, flaggedEdits in res:
+            yield int(flaggedEdits)
+
+    def getRevidBatchSize(self) -> int:
+        return 500 if self.site.has_right("apihighlimits") else 50
+
+    def requestFlaggedRevisionStatus(self, revids: List[int]) -> Dict[int, bool]:
+        status = {}
+        parameters = {
+            "action": "query",
+            "format": "json",
+            "prop": "revisions",
+            "rvprop": "flagged|ids",
+            "revids": "|".join(str(revid) for revid in revids),
+        }
+        while True:
+            data = pywikibot.data.api.Request(site=self.site, parameters=parameters).submit()
+            pages = data.get("query", {}).get("pages", {})
+            for page in pages:
+                for revision in pages[page].get("revisions", []):
+                    status[revision["revid"]] = "flagged" in revision
+            if "continue" not in data:
+                return status
+            parameters = {**parameters, **data["continue"]}
+
+    def iterFlaggedRevisionStatus(
+        self, revidChunks: Iterable[List[int]], readAhead: bool = True
+    ) -> Generator[Dict[int, bool], None, None]:
+        # Yields the flagged status of each chunk in order while the requests for the following chunks are
+        # already running. Requests that have not been started are cancelled when the caller stops early.
+        # Without readAhead a chunk is only requested after the previous one has been consumed, so a caller
+        # that stops early does not make more requests than a sequential lookup.
+        batchSize = self.getRevidBatchSize()
+        pending: Deque[List[Future]] = deque()
+        try:
+            for revids in revidChunks:
+                pending.append(
+                    [
+                        self.flaggedStatusExecutor.submit(self.requestFlaggedRevisionStatus, revids[i : i + batchSize])
+                        for i in range(0, len(revids), batchSize)
+                    ]
+                )
+                while pending and (
+                    not readAhead
+                    or len(pending) > 1
+                    and sum(len(futures) for futures in pending) >= self.flaggedStatusRequests
+                ):
+                    yield self.collectFlaggedRevisionStatus(pending.popleft())
+            while pending:
+                yield self.collectFlaggedRevisionStatus(pending.popleft())
+        finally:
+            for futures in pending:
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def collectFlaggedRevisionStatus(futures: List[Future]) -> Dict[int, bool]:
+        status: Dict[int, bool] = {}
+        for future in futures:
+            status.update(future.result())
+        return status
+
+    def getFlaggedEditCountsFromReplica(self, usernames: Iterable[str]) -> Dict[str, int]:
+        # exact flagged edit counts of many users, same window as getFlaggedEditChunkCountsFromReplica
+        usernames = sorted(set(usernames))
+        flaggedEditCounts = {username: 0 for username in usernames}
+        for i in range(0, len(usernames), self.replicaChunkSize):
+            chunk = usernames[i : i + self.replicaChunkSize]
+            placeholders = ",".join(["%s"] * len(chunk))
+            res = self.replica.query(
+                "SELECT actor_name, SUM(page_namespace IN (0, 10) AND fr_rev_id IS NOT NULL)"
+                " FROM (SELECT actor_name, page_namespace, fr_rev_id,"
+                " ROW_NUMBER() OVER (PARTITION BY rev_actor ORDER BY rev_timestamp DESC, rev_id DESC) AS contribNumber"
+                " FROM revision_userindex"
+                " JOIN actor_revision ON actor_id=rev_actor"
+                " JOIN page ON page_id=rev_page"
+                " LEFT JOIN flaggedrevs ON fr_rev_id=rev_id"
+                " JOIN (SELECT rev_actor AS lastEditActor, MAX(rev_timestamp) AS lastEditTimestamp"
+                " FROM revision_userindex JOIN actor_revision ON actor_id=rev_actor"
+                f" WHERE actor_name IN ({placeholders}) AND rev_deleted & 4 = 0 GROUP BY rev_actor) AS lastEdits"
+                " ON lastEditActor=rev_actor"
+                f" WHERE actor_name IN ({placeholders}) AND page_namespace IN (0, 6, 10, 14, 828)"
+                " AND rev_deleted & 4 = 0 AND rev_timestamp <= DATE_FORMAT("
+                "STR_TO_DATE(lastEditTimestamp, '%%Y%%m%%d%%H%%i%%s') - INTERVAL 2 DAY, '%%Y%%m%%d%%H%%i%%s')"
+                ") AS contribs WHERE contribNumber <= %s GROUP BY actor_name",
+                params=tuple(chunk) + tuple(chunk) + (self.getFlaggedEditContribLimit(),),
+            )
+            for rawUsername, flaggedEdits in res:
+                flaggedEditCounts[rawUsername.decode()] = int(flaggedEdits)
+        return flaggedEditCounts
+
+    def summarizeContributionsFromReplica(
+        self, usernames: Iterable[str], keepNewest: int
+    ) -> Dict[str, Tuple[ContributionSummary, ContributionSummary]]:
+        # all and article contributions of many users, streamed from the replica in a single pass per chunk
+        usernames = sorted(set(usernames))
+        summaries = {
+            username: (ContributionSummary(keepNewest), ContributionSummary(keepNewest)) for username in usernames
+        }
+        for i in range(0, len(usernames), self.replicaChunkSize):
+            chunk = usernames[i : i + self.replicaChunkSize]
+            placeholders = ",".join(["%s"] * len(chunk))
+            for rawUsername, namespace, rawTimestamp in self.replica.streamQuery(
+                "SELECT actor_name, page_namespace, rev_timestamp FROM revision_userindex"
+                " JOIN actor_revision ON actor_id=rev_actor"
+                " JOIN page ON page_id=rev_page"
+                f" WHERE actor_name IN ({placeholders}) AND rev_deleted & 4 = 0"
+                " ORDER BY rev_actor, rev_timestamp DESC, rev_id DESC",
+                params=tuple(chunk),
+            ):
+                contribSummary, articleContribSummary = summaries[rawUsername.decode()]
+                timestamp = parseReplicaTimestamp(rawTimestamp)
+                contribSummary.add(timestamp)
+                if namespace == 0:
+                    articleContribSummary.add(timestamp)
+        return summaries
+
+    def getFlaggedEditChunkCountsFromStore(self, user: pywikibot.User, readAhead: bool = True) -> Iterator[int]:
+        # flagged status is only requested again for revisions that were not reviewed yet
+        store = cast(ContributionStore, self.contributionStore)
+        (_, _, lastEditTimestamp, _) = user.last_edit
+        contribs = store.getContributions(
+            user,
+            [Namespace.MAIN, Namespace.FILE, Namespace.TEMPLATE, Namespace.CATEGORY, 828],
+            lastEditTimestamp - timedelta(days=2),
+            self.getFlaggedEditContribLimit(),
+        )
+        revidChunks = [
+            [
+                revid
+                for revid, namespace in zip(contribs.revids[i : i + 500], contribs.namespaces[i : i + 500])
+                if namespace == 0 or namespace == Namespace.TEMPLATE
+            ]
+            for i in range(0, len(contribs), 500)
+        ]
+        storedStatus = [store.getFlaggedStatus(revids) for revids in revidChunks]
+        refreshedStatus = self.iterFlaggedRevisionStatus(
+            [[revid for revid in revids if not status.get(revid)] for revids, status in zip(revidChunks, storedStatus)],
+            readAhead,
+        )
+        try:
+            for revids, status, refreshed in zip(revidChunks, storedStatus, refreshedStatus):
+                store.setFlaggedStatus(refreshed)
+                status.update(refreshed)
+                yield sum(1 for revid in revids if status.get(revid))
+        finally:
+            refreshedStatus.close()
+
+    def getFlaggedEditCount(self, user: pywikibot.User, exactResults: bool) -> int:
+        if self.flaggedCountBackend == "replica":
+            chunkCounts = self.getFlaggedEditChunkCountsFromReplica(user)
+        elif self.contributionStore:
+            chunkCounts = self.getFlaggedEditChunkCountsFromStore(user, readAhead=exactResults)
+        else:
+            # without exact results the count may stop after any chunk, requests for later ones could be wasted
+            chunkCounts = self.getFlaggedEditChunkCountsFromApi(user, readAhead=exactResults)
+        flaggedEdits = 0
+        for chunkCount in chunkCounts:
+            flaggedEdits += chunkCount
+            if not exactResults and flaggedEdits >= 200:
+                break
+        # cancels the flagged status requests that are no longer needed
+        chunkCounts.close()
         return flaggedEdits
 
-    def getUserData(self, user: pywikibot.User, endTime: datetime, exactResults: bool) -> UserData:
-        contribs = list(user.contributions(total=5000, start=endTime))
-        articleContribs = list(user.contributions(total=5000, start=endTime, namespaces=Namespace.MAIN))
-        flaggedEditCount = self.getFlaggedEditCount(user, exactResults)
-        return UserData(
+    def prefetchUserData(self, userData: UserData) -> None:
+        if not self.fetchExecutor:
+            for name in userData.loaders:
+                userData.load(name)
+            return
+        start = time.monotonic()
+        futures = {name: self.fetchExecutor.submit(userData.load, name) for name in userData.loaders}
+        errors: Dict[str, BaseException] = {}
+        for name, future in futures.items():
+            timeout = self.fetchTimeouts.get(name, self.defaultFetchTimeout)
+            try:
+                future.result(timeout=max(0, start + timeout - time.monotonic()))
+            except FutureTimeoutError:
+                future.cancel()
+                errors[name] = TimeoutError(f"no result after {timeout}s")
+            except Exception as e:  # pylint: disable=broad-except
+                errors[name] = e
+        if errors:
+            raise UserDataFetchError(errors)
+
+    def getUserData(
+        self, user: pywikibot.User, endTime: datetime, exactResults: bool, prefetch: bool = False
+    ) -> UserData:
+        userData = UserData(
             user,
-            user.editCount(force=True),
-            contribs,
-            articleContribs,
-            flaggedEditCount,
-            self.site.logevents(page=f"User:{user.username}"),
-            self.getUserRegistrationTimeSafe(user),
-            self.getFlaggedRevsUserParams(user),
+            {
+                "metadata": lambda: self.getUserMetadata(user),
+                "contribs": lambda: self.getContributions(user, endTime, None, exactResults),
+                "articleContribs": lambda: self.getContributions(user, endTime, [Namespace.MAIN], exactResults),
+                "flaggedEditCount": lambda: self.getFlaggedEditCount(user, exactResults),
+                "eventLogFlags": lambda: self.getEventLogFlags(self.site.logevents(page=f"User:{user.username}")),
+                "registrationTime": lambda: self.getUserRegistrationTimeSafe(user),
+                "flaggedRevsUserParams": lambda: self.getFlaggedRevsUserParams(user),
+            },
         )
+        # precomputed by a bulk replica query for the whole candidate set
+        history = self.userHistory.get(user.username)
+        if history is not None:
+            userData.values["eventLogFlags"] = (history.wasBlockedBefore, history.hadReviewRightsRemovedBefore)
+            if history.registrationTime is not None:
+                userData.values["registrationTime"] = history.registrationTime
+        if prefetch:
+            self.prefetchUserData(userData)
+        return userData
+
+    def getContributions(
+        self, user: pywikibot.User, endTime: datetime, namespaces: Optional[List[int]], exactResults: bool
+    ) -> Contributions:
+        # without exact results the criteria stop paging once they have seen enough contributions
+        streamPageSize = None if exactResults else self.streamPageSize
+        if self.contributionStore:
+            return self.contributionStore.getContributions(user, namespaces, endTime, 5000, streamPageSize)
+        return fetchContributions(user, namespaces, 5000, start=endTime, streamPageSize=streamPageSize)
+
+    def getUserMetadata(self, user: pywikibot.User) -> UserMetadata:
+        metadata = self.userMetadata.get(user.username)
+        if metadata is None:
+            raise Exception(f"User {user.username} does not exist.")
+        return metadata
 
     def getUserRegistrationTimeSafe(self, user: pywikibot.User) -> pywikibot.Timestamp:
-        registrationTime = user.registration()
+        registrationTime = self.getUserMetadata(user).registrationTime
         if registrationTime:
             return registrationTime
 
@@ -144,24 +574,26 @@ class CriteriaChecker:
         else:
             raise NotImplementedError
 
-    def checkGeneralEventLogCriterias(self, events) -> List[CriteriaCheck]:
-        criteriaChecks = []
-        wasBlockedBefore = False
-        hadReviewRightsRemovedBefore = False
+    @staticmethod
+    def getEventLogFlags(events) -> Tuple[bool, bool]:
+        # (wasBlockedBefore, hadReviewRightsRemovedBefore), only the newest matching event counts
         for ev in events:
             if ev.type() == "rights":
                 rightsEv = cast(pywikibot.logentries.RightsEntry, ev)
                 if rightsEv.oldgroups is None or rightsEv.newgroups is None:
                     continue
-                if "editor" in rightsEv.oldgroups and not "editor" in rightsEv.newgroups:
-                    hadReviewRightsRemovedBefore = True
-                    break
-                if "autoreview" in rightsEv.oldgroups and not "autoreview" in rightsEv.newgroups:
-                    hadReviewRightsRemovedBefore = True
-                    break
+                if isReviewRightsRemoval(rightsEv.oldgroups, rightsEv.newgroups):
+                    return (False, True)
             if ev.type() == "block" and ev.action() == "block":
-                wasBlockedBefore = True
-                break
+                return (True, False)
+        return (False, False)
+
+    def checkGeneralEventLogCriterias(self, events) -> List[CriteriaCheck]:
+        wasBlockedBefore, hadReviewRightsRemovedBefore = self.getEventLogFlags(events)
+        return self.checkEventLogFlags(wasBlockedBefore, hadReviewRightsRemovedBefore)
+
+    def checkEventLogFlags(self, wasBlockedBefore: bool, hadReviewRightsRemovedBefore: bool) -> List[CriteriaCheck]:
+        criteriaChecks = []
         if hadReviewRightsRemovedBefore:
             criteriaChecks.append(CriteriaCheck(False, "Dem Benutzer wurden Sicherrechte schon einmal entzogen."))
         else:
@@ -172,13 +604,16 @@ class CriteriaChecker:
             criteriaChecks.append(CriteriaCheck(True, "Der Benutzer wurde noch nie gesperrt."))
         return criteriaChecks
 
-    def checkGeneralEligibilityForPromotion(self, user: pywikibot.User) -> List[CriteriaCheck]:
+    def checkGeneralEligibilityForPromotion(self, metadata: UserMetadata) -> List[CriteriaCheck]:
+        return self.checkBlockAndBotStatus(metadata.blocked, metadata.isBot)
+
+    def checkBlockAndBotStatus(self, blocked: bool, isBot: bool) -> List[CriteriaCheck]:
         criteriaChecks = []
-        if user.is_blocked():
+        if blocked:
             criteriaChecks.append(CriteriaCheck(False, "Benutzer ist gesperrt."))
         else:
             criteriaChecks.append(CriteriaCheck(True, "Benutzer ist nicht gesperrt."))
-        if self.site.isBot(user.username):
+        if isBot:
             criteriaChecks.append(CriteriaCheck(False, "Benutzer ist ein Bot."))
         else:
             criteriaChecks.append(CriteriaCheck(True, "Benutzer ist kein Bot."))
@@ -226,14 +661,23 @@ class CriteriaChecker:
         return criteriaChecks
 
     def checkArticleEditCountOrFlaggedEditCount(
-        self, flaggedRevsUserParams, flaggedEditCount: int, minimumEditCount: int, minimumFlaggedEditCount: int
+        self,
+        flaggedRevsUserParams,
+        loadFlaggedEditCount: Callable[[], int],
+        minimumEditCount: int,
+        minimumFlaggedEditCount: int,
     ) -> List[CriteriaCheck]:
-        criteriaChecks = []
-
-        totalContentEdits = (
-            int(flaggedRevsUserParams["totalContentEdits"]) if "totalContentEdits" in flaggedRevsUserParams else 0
+        totalContentEdits = self.getTotalContentEdits(flaggedRevsUserParams)
+        # only fetch the expensive flagged edit count if the content edits are not sufficient
+        flaggedEditCount = loadFlaggedEditCount() if totalContentEdits < minimumEditCount else 0
+        return self.checkContentOrFlaggedEditCount(
+            totalContentEdits, flaggedEditCount, minimumEditCount, minimumFlaggedEditCount
         )
 
+    def checkContentOrFlaggedEditCount(
+        self, totalContentEdits: int, flaggedEditCount: int, minimumEditCount: int, minimumFlaggedEditCount: int
+    ) -> List[CriteriaCheck]:
+        criteriaChecks = []
         if totalContentEdits < minimumEditCount and flaggedEditCount < minimumFlaggedEditCount:
             criteriaChecks.append(
                 CriteriaCheck(
@@ -259,11 +703,10 @@ class CriteriaChecker:
         return criteriaChecks
 
     def checkMinimumEditedArticlePages(self, flaggedRevsUserParams, minimumSeparatePages: int) -> List[CriteriaCheck]:
+        return self.checkArticlePageCount(self.getArticlePageCount(flaggedRevsUserParams), minimumSeparatePages)
+
+    def checkArticlePageCount(self, articlePageCount: int, minimumSeparatePages: int) -> List[CriteriaCheck]:
         criteriaChecks = []
-        uniqueContentPages = (
-            flaggedRevsUserParams["uniqueContentPages"] if "uniqueContentPages" in flaggedRevsUserParams else ""
-        )
-        articlePageCount = 0 if not uniqueContentPages else len(list(uniqueContentPages.split(",")))
         if articlePageCount < minimumSeparatePages:
             criteriaChecks.append(
                 CriteriaCheck(
@@ -280,15 +723,33 @@ class CriteriaChecker:
             )
         return criteriaChecks
 
-    def checkSpacedEdits(self, contribs, minimumSpacedEdits: int) -> List[CriteriaCheck]:
-        criteriaChecks = []
-        if len(contribs) > 0:
-            lastContrib = contribs[0]
-            spacedEditCount = 0
-            for contrib in contribs:
-                if lastContrib[2] - contrib[2] > timedelta(days=3):
+    @staticmethod
+    def getSpacedEditCount(contribs: Contributions, stopAt: Optional[int] = None) -> int:
+        spacedEditCount = 0
+        if contribs.ensure(1):
+            lastTimestamp = contribs.timestamps[0]
+            index = 1
+            while (stopAt is None or spacedEditCount < stopAt) and contribs.ensure(index + 1):
+                timestamp = contribs.timestamps[index]
+                if lastTimestamp - timestamp > 3 * 86400:
                     spacedEditCount += 1
-                    lastContrib = contrib
+                    lastTimestamp = timestamp
+                index += 1
+        return spacedEditCount
+
+    def checkSpacedEdits(self, contribs: Contributions, minimumSpacedEdits: int) -> List[CriteriaCheck]:
+        if not contribs.ensure(1):
+            return self.checkSpacedEditCount(None, minimumSpacedEdits)
+        # streamed contributions are only fetched until the minimum is reached
+        return self.checkSpacedEditCount(
+            self.getSpacedEditCount(contribs, None if contribs.isComplete() else minimumSpacedEdits),
+            minimumSpacedEdits,
+        )
+
+    def checkSpacedEditCount(self, spacedEditCount: Optional[int], minimumSpacedEdits: int) -> List[CriteriaCheck]:
+        # spacedEditCount is None if there are no edits at all
+        criteriaChecks = []
+        if spacedEditCount is not None:
             if spacedEditCount < minimumSpacedEdits:
                 criteriaChecks.append(
                     CriteriaCheck(
@@ -315,10 +776,14 @@ class CriteriaChecker:
     def checkCustomSummaryEditCount(
         self, flaggedRevsUserParams, minimumEditsWithCustomSummary: int
     ) -> List[CriteriaCheck]:
-        criteriaChecks = []
-        customSummaryCount = (
-            int(flaggedRevsUserParams["editComments"]) if "editComments" in flaggedRevsUserParams else 0
+        return self.checkCustomSummaryCount(
+            self.getCustomSummaryCount(flaggedRevsUserParams), minimumEditsWithCustomSummary
         )
+
+    def checkCustomSummaryCount(
+        self, customSummaryCount: int, minimumEditsWithCustomSummary: int
+    ) -> List[CriteriaCheck]:
+        criteriaChecks = []
         if customSummaryCount < minimumEditsWithCustomSummary:
             criteriaChecks.append(
                 CriteriaCheck(
@@ -335,10 +800,24 @@ class CriteriaChecker:
             )
         return criteriaChecks
 
-    def checkRecentArticleEditCount(self, articleContribs, minimumEditCount: int, lastXDays) -> List[CriteriaCheck]:
+    def checkRecentArticleEditCount(
+        self, articleContribs: Contributions, minimumEditCount: int, lastXDays
+    ) -> List[CriteriaCheck]:
+        if minimumEditCount > 0 and articleContribs.ensure(minimumEditCount):
+            nthNewestTimestamp: Optional[int] = articleContribs.timestamps[minimumEditCount - 1]
+        else:
+            nthNewestTimestamp = None
+        return self.checkRecentArticleEdits(nthNewestTimestamp, minimumEditCount, lastXDays)
+
+    def checkRecentArticleEdits(
+        self, nthNewestTimestamp: Optional[int], minimumEditCount: int, lastXDays
+    ) -> List[CriteriaCheck]:
+        # nthNewestTimestamp is the time of the minimumEditCount-th newest article edit, None if there are fewer
         criteriaChecks = []
-        if len(articleContribs) < minimumEditCount or datetime.now() - articleContribs[4][2] > timedelta(
-            days=lastXDays
+        now = datetime.now()
+        nowEpoch = toEpoch(now) + now.microsecond / 1000000
+        if minimumEditCount > 0 and (
+            nthNewestTimestamp is None or nowEpoch - nthNewestTimestamp > lastXDays * 86400
         ):
             criteriaChecks.append(
                 CriteriaCheck(
@@ -355,9 +834,24 @@ class CriteriaChecker:
             )
         return criteriaChecks
 
-    def checkRevertCountRatio(self, contribs, flaggedRevsUserParams, maxRatio: float) -> List[CriteriaCheck]:
-        criteriaChecks = []
+    def checkRevertCountRatio(
+        self, contribs: Contributions, flaggedRevsUserParams, maxRatio: float
+    ) -> List[CriteriaCheck]:
         if not "revertedEdits" in flaggedRevsUserParams:
+            return self.checkRevertRatio(None, 0, maxRatio)
+        revertedEdits = float(flaggedRevsUserParams["revertedEdits"])
+        # once there are enough contributions for the ratio to be low enough the rest is not needed
+        if maxRatio > 0 and not contribs.isComplete():
+            contribs.ensure(math.ceil(revertedEdits / maxRatio))
+        else:
+            contribs.loadAll()
+        return self.checkRevertRatio(revertedEdits, len(contribs), maxRatio)
+
+    def checkRevertRatio(
+        self, revertedEdits: Optional[float], contribCount: int, maxRatio: float
+    ) -> List[CriteriaCheck]:
+        criteriaChecks = []
+        if revertedEdits is None:
             criteriaChecks.append(
                 CriteriaCheck(
                     True,
@@ -365,7 +859,7 @@ class CriteriaChecker:
                 )
             )
         else:
-            actRatio = float(flaggedRevsUserParams["revertedEdits"]) / len(contribs)
+            actRatio = revertedEdits / contribCount
             if actRatio > maxRatio:
                 criteriaChecks.append(
                     CriteriaCheck(
@@ -382,33 +876,127 @@ class CriteriaChecker:
                 )
         return criteriaChecks
 
-    def checkUserEligibleForReviewGroup(self, userData: UserData) -> List[CriteriaCheck]:
-        criteriaChecks: List[CriteriaCheck] = []
-        criteriaChecks += self.checkGeneralEligibilityForPromotion(userData.user)
-        criteriaChecks += self.checkGeneralEventLogCriterias(userData.logEntries)
-        criteriaChecks += self.checkRegistrationTime(userData.registrationTime, 60)
-        criteriaChecks += self.checkEditCount(userData.editCount, 300)
-        criteriaChecks += self.checkArticleEditCountOrFlaggedEditCount(
-            userData.flaggedRevsUserParams, userData.flaggedEditCount, 300, 200
-        )
-        criteriaChecks += self.checkSpacedEdits(userData.contribs, 15)
-        criteriaChecks += self.checkMinimumEditedArticlePages(userData.flaggedRevsUserParams, 14)
-        criteriaChecks += self.checkRecentArticleEditCount(userData.articleContribs, 5, 30)
-        criteriaChecks += self.checkCustomSummaryEditCount(userData.flaggedRevsUserParams, 30)
-        criteriaChecks += self.checkRevertCountRatio(userData.contribs, userData.flaggedRevsUserParams, 0.03)
+    def getEarliestEligibilityTime(
+        self, userData: UserData, thresholds: GroupThresholds, permanentRecheckDays: int = 90
+    ) -> Tuple[datetime, str]:
+        # Only uses data that has already been loaded and criteria that can not be met before a certain time:
+        # the account age, the spaced edits (at most one more every three days) and the log entries, which
+        # never change (rechecked after permanentRecheckDays anyway).
+        now = datetime.now()
+        horizons = [(now, "")]
+        if "registrationTime" in userData.values:
+            horizons.append(
+                (
+                    userData.registrationTime + timedelta(days=thresholds.minimumAgeInDays),
+                    f"account younger than {thresholds.minimumAgeInDays} days",
+                )
+            )
+        spacedContribsName = "articleContribs" if thresholds.spacedEditsInArticlesOnly else "contribs"
+        if spacedContribsName in userData.values and userData.load(spacedContribsName).isComplete():
+            missingSpacedEdits = thresholds.minimumSpacedEdits - self.getSpacedEditCount(
+                userData.load(spacedContribsName)
+            )
+            if missingSpacedEdits > 1:
+                horizons.append(
+                    (now + timedelta(days=3 * (missingSpacedEdits - 1)), f"{missingSpacedEdits} spaced edits missing")
+                )
+        if "eventLogFlags" in userData.values:
+            for criteria in self.checkEventLogFlags(userData.wasBlockedBefore, userData.hadReviewRightsRemovedBefore):
+                if not criteria.met:
+                    horizons.append((now + timedelta(days=permanentRecheckDays), criteria.text))
+        return max(horizons, key=lambda horizon: horizon[0])
+
+    @staticmethod
+    def iterChecks(
+        checks: List[Callable[[], List[CriteriaCheck]]], stopAtFirstFailure: bool
+    ) -> Iterator[CriteriaCheck]:
+        for check in checks:
+            results = check()
+            yield from results
+            if stopAtFirstFailure and not all(criteria.met for criteria in results):
+                break
 
-        return criteriaChecks
+    @staticmethod
+    def runChecks(
+        checks: List[Callable[[], List[CriteriaCheck]]], stopAtFirstFailure: bool
+    ) -> List[CriteriaCheck]:
+        return list(CriteriaChecker.iterChecks(checks, stopAtFirstFailure))
+
+    def startPrefetch(self, userData: UserData) -> None:
+        # loads all data in the background, UserData.load waits for a value that is still being loaded
+        if self.fetchExecutor:
+            for name in userData.loaders:
+                self.fetchExecutor.submit(userData.load, name)
 
-    def checkUserEligibleForAutoReviewGroup(self, userData: UserData) -> List[CriteriaCheck]:
-        criteriaChecks: List[CriteriaCheck] = []
-        criteriaChecks += self.checkGeneralEligibilityForPromotion(userData.user)
-        criteriaChecks += self.checkGeneralEventLogCriterias(userData.logEntries)
-        criteriaChecks += self.checkRegistrationTime(userData.registrationTime, 30)
-        criteriaChecks += self.checkArticleEditCountOrFlaggedEditCount(
-            userData.flaggedRevsUserParams, userData.flaggedEditCount, 150, 50
+    def checkUserEligibleForGroup(
+        self, userData: UserData, thresholds: GroupThresholds, stopAtFirstFailure: bool = False
+    ) -> List[CriteriaCheck]:
+        return self.runChecks(self.getGroupChecks(userData, thresholds), stopAtFirstFailure)
+
+    def iterUserEligibleForGroup(
+        self, userData: UserData, thresholds: GroupThresholds, stopAtFirstFailure: bool = False
+    ) -> Iterator[CriteriaCheck]:
+        return self.iterChecks(self.getGroupChecks(userData, thresholds), stopAtFirstFailure)
+
+    def getGroupChecks(
+        self, userData: UserData, thresholds: GroupThresholds
+    ) -> List[Callable[[], List[CriteriaCheck]]]:
+        # checks are ordered by the cost of fetching the data they need
+        checks: List[Callable[[], List[CriteriaCheck]]] = []
+        checks.append(lambda: self.checkRegistrationTime(userData.registrationTime, thresholds.minimumAgeInDays))
+        if thresholds.minimumEditCount is not None:
+            minimumEditCount = thresholds.minimumEditCount
+            checks.append(lambda: self.checkEditCount(userData.editCount, minimumEditCount))
+        checks.append(lambda: self.checkGeneralEligibilityForPromotion(userData.metadata))
+        checks.append(
+            lambda: self.checkMinimumEditedArticlePages(
+                userData.flaggedRevsUserParams, thresholds.minimumSeparatePages
+            )
         )
-        criteriaChecks += self.checkSpacedEdits(userData.articleContribs, 7)
-        criteriaChecks += self.checkMinimumEditedArticlePages(userData.flaggedRevsUserParams, 8)
-        criteriaChecks += self.checkCustomSummaryEditCount(userData.flaggedRevsUserParams, 20)
+        checks.append(
+            lambda: self.checkCustomSummaryEditCount(
+                userData.flaggedRevsUserParams, thresholds.minimumEditsWithCustomSummary
+            )
+        )
+        checks.append(
+            lambda: self.checkEventLogFlags(userData.wasBlockedBefore, userData.hadReviewRightsRemovedBefore)
+        )
+        checks.append(
+            lambda: self.checkArticleEditCountOrFlaggedEditCount(
+                userData.flaggedRevsUserParams,
+                lambda: userData.flaggedEditCount,
+                thresholds.minimumContentEditCount,
+                thresholds.minimumFlaggedEditCount,
+            )
+        )
+        if thresholds.minimumRecentArticleEdits is not None:
+            minimumRecentArticleEdits = thresholds.minimumRecentArticleEdits
+            checks.append(
+                lambda: self.checkRecentArticleEditCount(
+                    userData.articleContribs, minimumRecentArticleEdits, thresholds.recentArticleEditDays
+                )
+            )
+        checks.append(
+            lambda: self.checkSpacedEdits(
+                userData.articleContribs if thresholds.spacedEditsInArticlesOnly else userData.contribs,
+                thresholds.minimumSpacedEdits,
+            )
+        )
+        if thresholds.maximumRevertRatio is not None:
+            maximumRevertRatio = thresholds.maximumRevertRatio
+            checks.append(
+                lambda: self.checkRevertCountRatio(
+                    userData.contribs, userData.flaggedRevsUserParams, maximumRevertRatio
+                )
+            )
+        return checks
 
-        return criteriaChecks
+    def checkUserEligibleForReviewGroup(
+        self, userData: UserData, stopAtFirstFailure: bool = False
+    ) -> List[CriteriaCheck]:
+        return self.checkUserEligibleForGroup(userData, REVIEW_THRESHOLDS, stopAtFirstFailure)
+
+    def checkUserEligibleForAutoReviewGroup(
+        self, userData: UserData, stopAtFirstFailure: bool = False
+    ) -> List[CriteriaCheck]:
+        return self.checkUserEligibleForGroup(userData, AUTOREVIEW_THRESHOLDS, stopAtFirstFailure)
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import calendar
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+
+class EligibilityHorizon:
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS eligibility_horizon ("
+                " username TEXT PRIMARY KEY,"
+                " notBefore INTEGER NOT NULL,"
+                " reason TEXT NOT NULL,"
+                " recordedAt INTEGER NOT NULL)"
+            )
+
+    @staticmethod
+    def toEpoch(time: datetime) -> int:
+        return calendar.timegm(time.timetuple())
+
+    def getPending(self, usernames: Iterable[str], now: datetime) -> Dict[str, Tuple[datetime, str]]:
+        usernames = list(usernames)
+        pending = {}
+        with self.lock:
+            for i in range(0, len(usernames), 500):
+                chunk = usernames[i : i + 500]
+                rows = self.connection.execute(
+                    "SELECT username, notBefore, reason FROM eligibility_horizon"
+                    f" WHERE notBefore > ? AND username IN ({','.join(['?'] * len(chunk))})",
+                    [self.toEpoch(now)] + chunk,
+                )
+                for username, notBefore, reason in rows:
+                    pending[username] = (datetime.utcfromtimestamp(notBefore), reason)
+        return pending
+
+    def record(self, username: str, notBefore: datetime, reason: str, now: datetime) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO eligibility_horizon VALUES (?, ?, ?, ?)",
+                (username, self.toEpoch(notBefore), reason, self.toEpoch(now)),
+            )
+
+    def clear(self, username: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM eligibility_horizon WHERE username=?", (username,))
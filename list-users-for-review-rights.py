@@ -6,17 +6,48 @@
 
 from __future__ import unicode_literals
 
+import argparse
+import hashlib
+import json
 import locale
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Any, List, Set, cast
+from typing import Any, Dict, List, Optional, Set, Tuple, cast
 
 import pytz
 import pywikibot
 
-from criteria import CriteriaChecker
+from checkpoint import RunCheckpoint
+from contribstore import ContributionStore
+from criteria import (
+    AUTOREVIEW_THRESHOLDS,
+    FLAGGED_COUNT_BACKENDS,
+    REVIEW_THRESHOLDS,
+    CriteriaChecker,
+    GroupThresholds,
+    UserData,
+)
+from horizon import EligibilityHorizon
+from reportindex import AUTOREVIEW_CANDIDATE, REVIEW_CANDIDATE, ReportedCandidatesIndex
+from throttle import SharedThrottle
+
+
+STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "list-users-for-review-rights.sqlite")
+
+
+def getShard(username: str, shardCount: int) -> int:
+    # stable between runs and processes unlike hash()
+    return int(hashlib.md5(username.encode("utf-8")).hexdigest(), 16) % shardCount
+
+
+def parseShard(value: str) -> Tuple[int, int]:
+    shard, separator, shardCount = value.partition("/")
+    if not separator or not shard.isdigit() or not shardCount.isdigit() or int(shard) >= int(shardCount):
+        raise argparse.ArgumentTypeError(f"Expected a shard like 0/4, not {value}")
+    return (int(shard), int(shardCount))
 
 
 @dataclass
@@ -26,106 +57,423 @@ class AlreadyReportedCandidates:
 
 
 class Program:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        concurrency: int = 1,
+        flaggedCountBackend: str = "api",
+        statePath: str = STATE_PATH,
+        useContributionStore: bool = False,
+        checkAll: bool = False,
+        batchEvaluation: bool = False,
+        snapshotPath: Optional[str] = None,
+        resume: bool = False,
+    ) -> None:
         self.site = pywikibot.Site()
         self.site.login()
         self.timezone = pytz.timezone("Europe/Berlin")
-        self.criteriaChecker = CriteriaChecker(self.site)
+        self.contributionStore = ContributionStore(statePath) if useContributionStore else None
+        self.criteriaChecker = CriteriaChecker(
+            self.site,
+            flaggedCountBackend=flaggedCountBackend,
+            replicaPoolSize=concurrency,
+            contributionStore=self.contributionStore,
+        )
+        self.concurrency = concurrency
+        self.throttle = SharedThrottle(self.site)
+        self.reportIndex = ReportedCandidatesIndex(statePath)
+        self.horizon = EligibilityHorizon(statePath)
+        self.checkAll = checkAll
+        # the snapshot is written from the features of the batch evaluation
+        self.batchEvaluation = batchEvaluation or snapshotPath is not None
+        self.snapshotPath = snapshotPath
+        self.checkpoint = RunCheckpoint(statePath)
+        self.checkpointInterval = 100
+        self.resume = resume
 
     @staticmethod
     def getDateString(date: int) -> str:
         dayFormat = "%-d" if os.name != "nt" else "%d"
         return date.strftime(f"{dayFormat}. %B %Y")
 
-    def getAlreadyReportedCandidates(self) -> AlreadyReportedCandidates:
-        page = pywikibot.Page(self.site, "Wikipedia:Gesichtete Versionen/Rechtevergabe/Botliste")
-        self.site.loadrevisions(page, rvdir=True, content=True, user=self.site.user())
-        actualRevs = page._revisions.values()
-        newText = None
-        reviewCandidates = set()
-        autoReviewCandidates = set()
+    @staticmethod
+    def parseAddedCandidates(addedText: str) -> Tuple[Set[str], Set[str]]:
+        reviewCandidates: Set[str] = set()
+        autoReviewCandidates: Set[str] = set()
         pattern = re.compile(r"\{\{Wikipedia:Gesichtete Versionen/Rechtevergabe/Vorlage\|([^}]+)\}\}")
-        for rev in [x for x in actualRevs]:
-            oldText = page.getOldVersion(rev.parent_id)
-            newText = rev.text
-            addedText = newText[len(oldText) :]
-            targetSet = set()
-            for line in addedText.split("\n"):
-                if line == "; Kandidaten für aktive Sichterrechte":
-                    targetSet = reviewCandidates
-                elif line == "; Kandidaten für passive Sichterrechte":
-                    targetSet = autoReviewCandidates
-                for match in pattern.finditer(line):
-                    user = match.group(1)
-                    targetSet.add(user)
-
-        return AlreadyReportedCandidates(reviewCandidates, autoReviewCandidates)
+        targetSet: Set[str] = set()
+        for line in addedText.split("\n"):
+            if line == "; Kandidaten für aktive Sichterrechte":
+                targetSet = reviewCandidates
+            elif line == "; Kandidaten für passive Sichterrechte":
+                targetSet = autoReviewCandidates
+            for match in pattern.finditer(line):
+                user = match.group(1)
+                targetSet.add(user)
+        return (reviewCandidates, autoReviewCandidates)
 
-    def listNewUsers(self) -> None:
-        alreadyReportedCandidates = self.getAlreadyReportedCandidates()
-        h24Ago = datetime.now() - timedelta(days=1)
-        startTime = datetime(h24Ago.year, h24Ago.month, h24Ago.day, 0, 0, 0)
-        endTime = startTime + timedelta(hours=24)
-        recentChanges = self.site.recentchanges(end=startTime, start=endTime)  # reverse order
+    def updateReportIndex(self) -> None:
+        page = pywikibot.Page(self.site, "Wikipedia:Gesichtete Versionen/Rechtevergabe/Botliste")
+        lastRevId = self.reportIndex.getLastRevId()
+        # start at the already indexed revision, the API rejects start ids that do not exist
+        self.site.loadrevisions(page, rvdir=True, content=True, user=self.site.user(), startid=lastRevId or None)
+        newRevs = sorted(
+            (rev for rev in page._revisions.values() if rev.revid > lastRevId),
+            key=lambda rev: rev.revid,
+        )
+        parentIds = [rev.parent_id for rev in newRevs if rev.parent_id and rev.parent_id not in page._revisions]
+        for i in range(0, len(parentIds), 50):
+            self.site.loadrevisions(page, revids=parentIds[i : i + 50], content=True)
+        for rev in newRevs:
+            oldText = page._revisions[rev.parent_id].text if rev.parent_id else ""
+            addedText = rev.text[len(oldText) :]
+            reviewCandidates, autoReviewCandidates = self.parseAddedCandidates(addedText)
+            self.reportIndex.addRevision(rev.revid, reviewCandidates, autoReviewCandidates)
+        print(f"Indexed {len(newRevs)} new revisions of the Botliste.")
+
+    def rebuildReportIndex(self) -> None:
+        self.reportIndex.clear()
+        self.updateReportIndex()
+
+    def getAlreadyReportedCandidates(self) -> AlreadyReportedCandidates:
+        self.updateReportIndex()
+        return AlreadyReportedCandidates(
+            self.reportIndex.getCandidates(REVIEW_CANDIDATE), self.reportIndex.getCandidates(AUTOREVIEW_CANDIDATE)
+        )
+
+    def getActiveUsernames(self, startTime: datetime, endTime: datetime) -> Set[str]:
+        # only request the user name and let the server filter out anonymous and bot edits and log entries
+        recentChanges = pywikibot.data.api.ListGenerator(
+            "recentchanges",
+            site=self.site,
+            parameters={
+                "rcprop": "user",
+                "rcshow": "!anon|!bot",
+                "rctype": "edit|new",
+                "rcstart": endTime,  # reverse order
+                "rcend": startTime,
+            },
+        )
         usernames = set()
         for ch in recentChanges:
             if "userhidden" in ch:
                 continue
-            if (ch["type"] == "edit" or ch["type"] == "new") and not "anon" in ch:
-                usernames.add(ch["user"])
-        usersToBePromoted = []
-        usersToBePromotedToAutoReview = []
-        print(f"Checking {len(usernames)} users for {startTime}...")
-        count = 0
-        for username in usernames:
-            count += 1
-            if count % 100 == 0:
-                print(f"Checked {count} users.")
-            user = pywikibot.User(self.site, username)
-            if not "review" in user.rights():
-                userData = self.criteriaChecker.getUserData(user, endTime, False)
-
-                # check for review rights
-                reviewCriteriaChecks = self.criteriaChecker.checkUserEligibleForReviewGroup(userData)
-                eligibleForReview = not list(filter(lambda criteria: not criteria.met, reviewCriteriaChecks))
-                if eligibleForReview and not username in alreadyReportedCandidates.reviewCandidates:
-                    usersToBePromoted.append(user)
-                    continue
-
-                # check for autoreview rights
-                if "autoreview" in user.rights() or username in alreadyReportedCandidates.autoReviewCandidates:
-                    continue
-                autoReviewCriteriaChecks = self.criteriaChecker.checkUserEligibleForAutoReviewGroup(userData)
-                eligibleForAutoReview = not list(filter(lambda criteria: not criteria.met, autoReviewCriteriaChecks))
-                if eligibleForAutoReview:
-                    usersToBePromotedToAutoReview.append(user)
+            usernames.add(ch["user"])
+        return usernames
+
+    def checkUser(
+        self, username: str, endTime: datetime, alreadyReportedCandidates: Optional[AlreadyReportedCandidates]
+    ) -> Tuple[bool, bool]:
+        # Without the already reported candidates (shard mode) both groups are checked independently
+        # and the merge step decides which candidates are new.
+        self.throttle.wait()
+        user = pywikibot.User(self.site, username)
+        metadata = self.criteriaChecker.getUserMetadata(user)
+        if "review" in metadata.rights:
+            return (False, False)
+        userData = self.criteriaChecker.getUserData(user, endTime, False)
+        reported = alreadyReportedCandidates or AlreadyReportedCandidates(set(), set())
+
+        # check for review rights
+        reviewCriteriaChecks = self.criteriaChecker.checkUserEligibleForReviewGroup(userData, True)
+        eligibleForReview = not list(filter(lambda criteria: not criteria.met, reviewCriteriaChecks))
+        if eligibleForReview and not username in reported.reviewCandidates and alreadyReportedCandidates is not None:
+            return (True, False)
+
+        # check for autoreview rights
+        if "autoreview" in metadata.rights or username in reported.autoReviewCandidates:
+            eligibleForAutoReview = False
+            checkedGroups = [REVIEW_THRESHOLDS]
+        else:
+            autoReviewCriteriaChecks = self.criteriaChecker.checkUserEligibleForAutoReviewGroup(userData, True)
+            eligibleForAutoReview = not list(filter(lambda criteria: not criteria.met, autoReviewCriteriaChecks))
+            checkedGroups = [REVIEW_THRESHOLDS, AUTOREVIEW_THRESHOLDS]
+
+        if not eligibleForReview and not eligibleForAutoReview:
+            self.recordEligibilityHorizon(username, userData, checkedGroups)
+        return (eligibleForReview and alreadyReportedCandidates is None, eligibleForAutoReview)
+
+    def recordEligibilityHorizon(self, username: str, userData: UserData, groups: List[GroupThresholds]) -> None:
+        self.saveEligibilityHorizon(
+            username, [self.criteriaChecker.getEarliestEligibilityTime(userData, thresholds) for thresholds in groups]
+        )
+
+    def saveEligibilityHorizon(self, username: str, horizons: List[Tuple[datetime, str]]) -> None:
+        now = datetime.now()
+        notBefore, reason = min(horizons, key=lambda horizon: horizon[0])
+        if notBefore > now + timedelta(days=1):
+            self.horizon.record(username, notBefore, reason, now)
+        else:
+            self.horizon.clear(username)
+
+    def extractUserFeatures(
+        self, username: str, endTime: datetime
+    ) -> Tuple[Optional[Dict[str, Any]], List[Tuple[datetime, str]]]:
+        from batcheval import extractFeatures  # pylint: disable=import-outside-toplevel
+
+        self.throttle.wait()
+        user = pywikibot.User(self.site, username)
+        if "review" in self.criteriaChecker.getUserMetadata(user).rights:
+            return (None, [])
+        # a snapshot needs the exact flagged edit count, replayed thresholds may require more than it stops at
+        userData = self.criteriaChecker.getUserData(user, endTime, self.snapshotPath is not None)
+        features = extractFeatures(self.criteriaChecker, userData, withFlaggedEditCount=self.snapshotPath is not None)
+        # the contributions are not kept, so the horizons for both groups are determined right away
+        horizons = [
+            self.criteriaChecker.getEarliestEligibilityTime(userData, thresholds)
+            for thresholds in (REVIEW_THRESHOLDS, AUTOREVIEW_THRESHOLDS)
+        ]
+        return (features, horizons)
+
+    def extractFeaturesOfUsers(
+        self, usernames: List[str], endTime: datetime
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Dict[str, List[Tuple[datetime, str]]]]:
+        features = []
+        horizons = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(lambda username: self.extractUserFeatures(username, endTime), usernames)
+            for username, (userFeatures, userHorizons) in zip(usernames, results):
+                if userFeatures is not None:
+                    features.append((username, userFeatures))
+                    horizons[username] = userHorizons
+        return (features, horizons)
 
+    def saveSnapshot(self, features: List[Tuple[str, Dict[str, Any]]]) -> None:
+        from batcheval import FeatureTable  # pylint: disable=import-outside-toplevel
+
+        table = FeatureTable.fromFeatures(features)
+        table.save(cast(str, self.snapshotPath))
+        print(f"Saved the features of {len(table)} users to {self.snapshotPath}.")
+
+    def evaluateUsersInBatch(
+        self,
+        features: List[Tuple[str, Dict[str, Any]]],
+        horizons: Dict[str, List[Tuple[datetime, str]]],
+        alreadyReportedCandidates: Optional[AlreadyReportedCandidates],
+    ) -> Tuple[List[str], List[str]]:
+        # numpy is only needed for the batch evaluation, snapshots and replays
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        from batcheval import FeatureTable, evaluateGroup, explainUser  # pylint: disable=import-outside-toplevel
+
+        table = FeatureTable.fromFeatures(features)
+        now = datetime.now()
+        eligibleForReview = evaluateGroup(table, REVIEW_THRESHOLDS, now)["eligible"]
+        eligibleForAutoReview = evaluateGroup(table, AUTOREVIEW_THRESHOLDS, now)["eligible"]
+        reported = alreadyReportedCandidates or AlreadyReportedCandidates(set(), set())
+        alreadyReportedForReview = np.array(
+            [username in reported.reviewCandidates for username in table.usernames], dtype=np.bool_
+        )
+        autoReviewNotChecked = table.columns["hasAutoReviewRight"] | np.array(
+            [username in reported.autoReviewCandidates for username in table.usernames], dtype=np.bool_
+        )
+        newReviewCandidates = eligibleForReview & ~alreadyReportedForReview
+        newAutoReviewCandidates = eligibleForAutoReview & ~autoReviewNotChecked
+        if alreadyReportedCandidates is not None:
+            newAutoReviewCandidates &= ~newReviewCandidates
+        for index in np.flatnonzero(~eligibleForReview & ~newAutoReviewCandidates):
+            username = table.usernames[index]
+            self.saveEligibilityHorizon(
+                username, horizons[username][:1] if autoReviewNotChecked[index] else horizons[username]
+            )
+        for candidates, thresholds in (
+            (newReviewCandidates, REVIEW_THRESHOLDS),
+            (newAutoReviewCandidates, AUTOREVIEW_THRESHOLDS),
+        ):
+            for index in np.flatnonzero(candidates):
+                criteriaTexts = "; ".join(
+                    criteria.text for criteria in explainUser(self.criteriaChecker, table, index, thresholds)
+                )
+                pywikibot.log(f"{table.usernames[index]}: {criteriaTexts}")
+        return (
+            [table.usernames[index] for index in np.flatnonzero(newReviewCandidates)],
+            [table.usernames[index] for index in np.flatnonzero(newAutoReviewCandidates)],
+        )
+
+    @staticmethod
+    def getCheckedDay() -> Tuple[datetime, datetime]:
+        h24Ago = datetime.now() - timedelta(days=1)
+        startTime = datetime(h24Ago.year, h24Ago.month, h24Ago.day, 0, 0, 0)
+        return (startTime, startTime + timedelta(hours=24))
+
+    def getUsernamesToCheck(
+        self, runKey: str, startTime: datetime, endTime: datetime, shard: Optional[Tuple[int, int]] = None
+    ) -> List[str]:
+        if self.resume:
+            checkpointUsernames = self.checkpoint.getUsernames(runKey)
+            if checkpointUsernames is not None:
+                print(f"Resuming {runKey} with {len(checkpointUsernames)} users.")
+                return checkpointUsernames
+        usernames = self.getActiveUsernames(startTime, endTime)
+        if shard is not None:
+            usernames = {username for username in usernames if getShard(username, shard[1]) == shard[0]}
+        activeUserCount = len(usernames)
+        # the prefilter and the horizons depend on the current thresholds, a snapshot has to contain the users
+        # that only relaxed thresholds make eligible
+        if self.snapshotPath is None:
+            usernames = self.criteriaChecker.prefilterCandidates(usernames)
+        if not self.checkAll and self.snapshotPath is None:
+            pending = self.horizon.getPending(usernames, datetime.now())
+            for username, (notBefore, reason) in sorted(pending.items()):
+                pywikibot.log(f"Skipping {username} until {notBefore:%Y-%m-%d}: {reason}")
+            print(f"Skipping {len(pending)} users that can not be eligible yet.")
+            usernames -= pending.keys()
+        print(f"Checking {len(usernames)} of {activeUserCount} users for {startTime}...")
+        sortedUsernames = sorted(usernames)
+        self.checkpoint.start(runKey, sortedUsernames)
+        return sortedUsernames
+
+    def findCandidates(
+        self,
+        runKey: str,
+        usernames: List[str],
+        endTime: datetime,
+        alreadyReportedCandidates: Optional[AlreadyReportedCandidates],
+    ) -> Tuple[List[str], List[str]]:
+        # the verdicts are checkpointed, so a resumed run only checks the remaining users
+        verdicts = self.checkpoint.getVerdicts(runKey)
+        remainingUsernames = [username for username in usernames if username not in verdicts]
+        if verdicts:
+            print(f"{len(verdicts)} users have already been checked, {len(remainingUsernames)} remaining.")
+        self.criteriaChecker.userMetadata.load(remainingUsernames)
+        self.criteriaChecker.userHistory.load(remainingUsernames)
+        if self.snapshotPath is not None:
+            # not cached by the skipped prefilter
+            self.criteriaChecker.flaggedRevsUserParams.update(
+                self.criteriaChecker.loadFlaggedRevsUserParams(remainingUsernames)
+            )
+        if self.batchEvaluation:
+            # evaluated and checkpointed in chunks, a failure only loses the current chunk
+            snapshotFeatures = []
+            for i in range(0, len(remainingUsernames), self.checkpointInterval):
+                chunk = remainingUsernames[i : i + self.checkpointInterval]
+                features, horizons = self.extractFeaturesOfUsers(chunk, endTime)
+                reviewCandidates, autoReviewCandidates = self.evaluateUsersInBatch(
+                    features, horizons, alreadyReportedCandidates
+                )
+                reviewCandidateSet, autoReviewCandidateSet = set(reviewCandidates), set(autoReviewCandidates)
+                newVerdicts = [
+                    (username, username in reviewCandidateSet, username in autoReviewCandidateSet)
+                    for username in chunk
+                ]
+                self.checkpoint.addVerdicts(runKey, newVerdicts)
+                verdicts.update((username, (review, autoReview)) for username, review, autoReview in newVerdicts)
+                if self.snapshotPath:
+                    snapshotFeatures += features
+                print(f"Checked {len(verdicts)} users.")
+            if self.snapshotPath and remainingUsernames:
+                if len(remainingUsernames) < len(usernames):
+                    print("The snapshot only contains the users checked since the run was resumed.")
+                self.saveSnapshot(snapshotFeatures)
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                results = executor.map(
+                    lambda username: self.checkUser(username, endTime, alreadyReportedCandidates), remainingUsernames
+                )
+                newVerdicts = []
+                for username, (eligibleForReview, eligibleForAutoReview) in zip(remainingUsernames, results):
+                    newVerdicts.append((username, eligibleForReview, eligibleForAutoReview))
+                    verdicts[username] = (eligibleForReview, eligibleForAutoReview)
+                    if len(newVerdicts) == self.checkpointInterval:
+                        self.checkpoint.addVerdicts(runKey, newVerdicts)
+                        newVerdicts = []
+                        print(f"Checked {len(verdicts)} users.")
+                self.checkpoint.addVerdicts(runKey, newVerdicts)
+        return (
+            [username for username in usernames if verdicts[username][0]],
+            [username for username in usernames if verdicts[username][1]],
+        )
+
+    def saveSection(self, startTime: datetime, reviewCandidates: List[str], autoReviewCandidates: List[str]) -> None:
         newSection = f"\n\n== {self.getDateString(startTime)} ==\n"
         newSection += "; Kandidaten für aktive Sichterrechte\n"
-        #        print(f"{len(usersToBePromoted)} Benutzer gefunden.")
-        if usersToBePromoted:
-            for user in sorted(usersToBePromoted):
-                newSection += f"* {{{{Wikipedia:Gesichtete Versionen/Rechtevergabe/Vorlage|{user.username}}}}}\n"
+        #        print(f"{len(reviewCandidates)} Benutzer gefunden.")
+        if reviewCandidates:
+            for username in sorted(reviewCandidates):
+                newSection += f"* {{{{Wikipedia:Gesichtete Versionen/Rechtevergabe/Vorlage|{username}}}}}\n"
         else:
             newSection += f":''keine''\n"
         newSection += "\n"
         newSection += "; Kandidaten für passive Sichterrechte\n"
-        #        print(f"{len(usersToBePromotedToAutoReview)} Benutzer gefunden.")
-        if usersToBePromotedToAutoReview:
-            for user in sorted(usersToBePromotedToAutoReview):
-                newSection += f"* {{{{Wikipedia:Gesichtete Versionen/Rechtevergabe/Vorlage|{user.username}}}}}\n"
+        #        print(f"{len(autoReviewCandidates)} Benutzer gefunden.")
+        if autoReviewCandidates:
+            for username in sorted(autoReviewCandidates):
+                newSection += f"* {{{{Wikipedia:Gesichtete Versionen/Rechtevergabe/Vorlage|{username}}}}}\n"
         else:
             newSection += f":''keine''\n"
 
-        if not usersToBePromoted and not usersToBePromotedToAutoReview:
+        if not reviewCandidates and not autoReviewCandidates:
             newSection += f"{{{{Erledigt|--~~~~}}}}\n"
 
         page = pywikibot.Page(self.site, "Wikipedia:Gesichtete Versionen/Rechtevergabe/Botliste")
+        # a resumed or repeated run must not add the section twice
+        if f"\n== {self.getDateString(startTime)} ==\n" in page.text:
+            print(f"The Botliste already has a section for {self.getDateString(startTime)}, not saving it again.")
+            return
         page.text += newSection
         page.save(summary=f"Bot: Neue Kandidaten für den {self.getDateString(startTime)} hinzugefügt.")
 
         print(newSection)
 
+    def listNewUsers(self) -> None:
+        alreadyReportedCandidates = self.getAlreadyReportedCandidates()
+        startTime, endTime = self.getCheckedDay()
+        runKey = f"{startTime:%Y-%m-%d}"
+        usernames = self.getUsernamesToCheck(runKey, startTime, endTime)
+        reviewCandidates, autoReviewCandidates = self.findCandidates(
+            runKey, usernames, endTime, alreadyReportedCandidates
+        )
+        if self.contributionStore:
+            self.contributionStore.evict()
+        self.saveSection(startTime, reviewCandidates, autoReviewCandidates)
+        self.checkpoint.clear(runKey)
+
+    @staticmethod
+    def getShardResultPath(shardDir: str, startTime: datetime, shard: int, shardCount: int) -> str:
+        return os.path.join(shardDir, f"{startTime:%Y-%m-%d}-shard-{shard}-of-{shardCount}.json")
+
+    def listNewUsersOfShard(self, shard: int, shardCount: int, shardDir: str) -> None:
+        # the already reported candidates are filtered out when merging, so no shard needs the report index
+        startTime, endTime = self.getCheckedDay()
+        runKey = f"{startTime:%Y-%m-%d} shard {shard}/{shardCount}"
+        usernames = self.getUsernamesToCheck(runKey, startTime, endTime, (shard, shardCount))
+        reviewCandidates, autoReviewCandidates = self.findCandidates(runKey, usernames, endTime, None)
+        if self.contributionStore:
+            self.contributionStore.evict()
+        path = self.getShardResultPath(shardDir, startTime, shard, shardCount)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "checkedUsers": len(usernames),
+                    "reviewCandidates": reviewCandidates,
+                    "autoReviewCandidates": autoReviewCandidates,
+                },
+                f,
+            )
+        os.replace(path + ".tmp", path)
+        self.checkpoint.clear(runKey)
+        print(f"Saved {len(reviewCandidates)} + {len(autoReviewCandidates)} candidates of shard {shard}/{shardCount}.")
+
+    def mergeShards(self, shardCount: int, shardDir: str) -> None:
+        startTime, _ = self.getCheckedDay()
+        paths = [self.getShardResultPath(shardDir, startTime, shard, shardCount) for shard in range(shardCount)]
+        missingPaths = [path for path in paths if not os.path.exists(path)]
+        if missingPaths:
+            raise Exception(f"Missing shard results: {', '.join(missingPaths)}")
+        reviewCandidates: Set[str] = set()
+        autoReviewCandidates: Set[str] = set()
+        checkedUsers = 0
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                shardResult = json.load(f)
+            checkedUsers += shardResult["checkedUsers"]
+            reviewCandidates.update(shardResult["reviewCandidates"])
+            autoReviewCandidates.update(shardResult["autoReviewCandidates"])
+        print(f"Merging the results of {shardCount} shards with {checkedUsers} checked users.")
+        alreadyReportedCandidates = self.getAlreadyReportedCandidates()
+        reviewCandidates -= alreadyReportedCandidates.reviewCandidates
+        autoReviewCandidates -= alreadyReportedCandidates.autoReviewCandidates | reviewCandidates
+        self.saveSection(startTime, sorted(reviewCandidates), sorted(autoReviewCandidates))
+
     def checkSingleUser(self) -> None:
         crit = self.criteriaChecker.checkUserEligibleForReviewGroup(
             self.criteriaChecker.getUserData(
@@ -138,11 +486,148 @@ class Program:
             print(f"User eligible")
 
 
+def replaySnapshot(path: str, reviewOverrides: List[str], autoReviewOverrides: List[str]) -> None:
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    from batcheval import (  # pylint: disable=import-outside-toplevel
+        UNKNOWN_FLAGGED_EDIT_COUNT,
+        FeatureTable,
+        evaluateGroup,
+        replaceThresholds,
+    )
+
+    table = FeatureTable.load(path)
+    print(f"Replaying {len(table)} users fetched at {table.createdAt:%Y-%m-%d %H:%M}.")
+    for groupName, thresholds, overrides in (
+        ("review", REVIEW_THRESHOLDS, reviewOverrides),
+        ("autoreview", AUTOREVIEW_THRESHOLDS, autoReviewOverrides),
+    ):
+        newThresholds = replaceThresholds(thresholds, overrides)
+        current = evaluateGroup(table, thresholds)
+        replayed = evaluateGroup(table, newThresholds)
+        print(f"\n{groupName}: {newThresholds}")
+        print(f"eligible: {current['eligible'].sum()} now, {replayed['eligible'].sum()} with the new thresholds")
+        for criterion, met in replayed.items():
+            if criterion != "eligible":
+                print(f"  {criterion}: {(~met).sum()} users fail")
+        # the flagged edit count was only fetched if the content edits did not meet the current thresholds
+        unknownFlaggedEditCounts = (table.columns["flaggedEditCount"] == UNKNOWN_FLAGGED_EDIT_COUNT) & (
+            table.columns["totalContentEdits"] < newThresholds.minimumContentEditCount
+        )
+        if unknownFlaggedEditCounts.any():
+            print(f"  no flagged edit count for {unknownFlaggedEditCounts.sum()} users, they fail that criterion")
+        for label, changed in (
+            ("newly eligible", replayed["eligible"] & ~current["eligible"]),
+            ("no longer eligible", current["eligible"] & ~replayed["eligible"]),
+        ):
+            usernames = [table.usernames[index] for index in np.flatnonzero(changed)]
+            print(f"{label} ({len(usernames)}): {', '.join(usernames)}")
+
+
 def main() -> None:
     locale.setlocale(locale.LC_ALL, "de_DE.utf8")
-    pywikibot.handle_args()
-    # Program().checkSingleUser()
-    Program().listNewUsers()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="number of users that are checked at the same time"
+    )
+    parser.add_argument(
+        "--flagged-count-backend",
+        choices=FLAGGED_COUNT_BACKENDS,
+        default="api",
+        help="count flagged edits with the API or directly on the replica",
+    )
+    parser.add_argument("--state", default=STATE_PATH, help="SQLite file for the state kept between runs")
+    parser.add_argument(
+        "--rebuild-report-index",
+        action="store_true",
+        help="rebuild the index of already reported candidates from the whole Botliste history and exit",
+    )
+    parser.add_argument(
+        "--contribution-store",
+        action="store_true",
+        help="keep the contributions of checked users in the state file and only fetch newer ones",
+    )
+    parser.add_argument(
+        "--check-all",
+        action="store_true",
+        help="also check users that have been found to be not eligible before a later date",
+    )
+    parser.add_argument(
+        "--batch-evaluation",
+        action="store_true",
+        help="load the features of all users first and evaluate the criteria for all of them at once",
+    )
+    parser.add_argument(
+        "--export-snapshot",
+        metavar="PATH",
+        help="save the fetched features of all active users to a compressed snapshot (.npz) for --replay,"
+        " without skipping users that can not be eligible with the current thresholds",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="SNAPSHOT",
+        help="evaluate the criteria on a snapshot without network access and compare them to the current thresholds",
+    )
+    parser.add_argument(
+        "--review-threshold",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="threshold of the review group to change for --replay, e.g. minimumSpacedEdits=10",
+    )
+    parser.add_argument(
+        "--autoreview-threshold",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="threshold of the autoreview group to change for --replay",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parseShard,
+        metavar="I/N",
+        help="only check the users of shard I of N and save the candidates to --shard-dir instead of the Botliste",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        type=int,
+        metavar="N",
+        help="combine the candidates of all N shards from --shard-dir and save them to the Botliste",
+    )
+    parser.add_argument("--shard-dir", default=".", help="directory shared by the shards and the merge step")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the interrupted run of the same day and skip the users that have already been checked",
+    )
+    args, _ = parser.parse_known_args(pywikibot.handle_args())
+    if args.shard and args.state == STATE_PATH:
+        # a user always ends up in the same shard, so every shard keeps its own contributions and horizons
+        args.state = f"{os.path.splitext(STATE_PATH)[0]}-shard-{args.shard[0]}-of-{args.shard[1]}.sqlite"
+    if args.replay:
+        replaySnapshot(args.replay, args.review_threshold, args.autoreview_threshold)
+        return
+    program = Program(
+        concurrency=args.concurrency,
+        flaggedCountBackend=args.flagged_count_backend,
+        statePath=args.state,
+        useContributionStore=args.contribution_store,
+        checkAll=args.check_all,
+        batchEvaluation=args.batch_evaluation,
+        snapshotPath=args.export_snapshot,
+        resume=args.resume,
+    )
+    if args.rebuild_report_index:
+        program.rebuildReportIndex()
+        return
+    if args.shard:
+        program.listNewUsersOfShard(args.shard[0], args.shard[1], args.shard_dir)
+        return
+    if args.merge_shards:
+        program.mergeShards(args.merge_shards, args.shard_dir)
+        return
+    # program.checkSingleUser()
+    program.listNewUsers()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional, Tuple
+
+import pymysql
+from pywikibot import config
+
+
+class ReplicaConnectionPool:
+    def __init__(self, dbname: str, size: int = 4, healthCheckInterval: float = 60) -> None:
+        self.dbname = dbname
+        self.healthCheckInterval = healthCheckInterval
+        self.slots = threading.BoundedSemaphore(size)
+        self.idleConnections: "queue.LifoQueue[Tuple[float, pymysql.connections.Connection]]" = queue.LifoQueue()
+
+    def connect(self) -> pymysql.connections.Connection:
+        if config.db_connect_file is None:
+            credentials = {"user": config.db_username, "password": config.db_password}
+        else:
+            credentials = {"read_default_file": config.db_connect_file}
+        # autocommit, otherwise a long-lived connection keeps reading from the snapshot of its first query
+        return pymysql.connect(
+            host=config.db_hostname_format.format(self.dbname),
+            database=config.db_name_format.format(self.dbname),
+            port=config.db_port,
+            charset="utf8",
+            autocommit=True,
+            **credentials,
+        )
+
+    def getIdleConnection(self) -> pymysql.connections.Connection:
+        while True:
+            try:
+                lastUsed, connection = self.idleConnections.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if time.monotonic() - lastUsed < self.healthCheckInterval:
+                return connection
+            # the replicas close connections that have been idle for too long
+            try:
+                connection.ping(reconnect=True)
+                return connection
+            except pymysql.MySQLError:
+                connection.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[pymysql.connections.Connection]:
+        with self.slots:
+            connection: Optional[pymysql.connections.Connection] = self.getIdleConnection()
+            try:
+                yield connection
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+                connection.close()
+                connection = None
+                raise
+            finally:
+                if connection is not None:
+                    self.idleConnections.put((time.monotonic(), connection))
+
+    def query(self, query: str, params: Any = None) -> List[Tuple[Any, ...]]:
+        with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return list(cursor.fetchall())
+
+    def streamQuery(self, query: str, params: Any = None) -> Iterator[Tuple[Any, ...]]:
+        # the rows are read from the server while they are processed instead of being buffered
+        with self.connection() as connection, connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query, params)
+            yield from cursor
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import sqlite3
+from typing import Iterable, Set
+
+REVIEW_CANDIDATE = "review"
+AUTOREVIEW_CANDIDATE = "autoreview"
+
+
+class ReportedCandidatesIndex:
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS reported_candidates ("
+                " username TEXT NOT NULL,"
+                " candidateType TEXT NOT NULL,"
+                " revid INTEGER NOT NULL,"
+                " PRIMARY KEY (username, candidateType))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS reported_candidates_state (lastRevId INTEGER NOT NULL)"
+            )
+
+    def getLastRevId(self) -> int:
+        row = self.connection.execute("SELECT lastRevId FROM reported_candidates_state").fetchone()
+        return row[0] if row else 0
+
+    def getCandidates(self, candidateType: str) -> Set[str]:
+        rows = self.connection.execute(
+            "SELECT username FROM reported_candidates WHERE candidateType=?", (candidateType,)
+        )
+        return {row[0] for row in rows}
+
+    def addRevision(
+        self, revid: int, reviewCandidates: Iterable[str], autoReviewCandidates: Iterable[str]
+    ) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO reported_candidates VALUES (?, ?, ?)",
+                [(username, REVIEW_CANDIDATE, revid) for username in reviewCandidates]
+                + [(username, AUTOREVIEW_CANDIDATE, revid) for username in autoReviewCandidates],
+            )
+            self.connection.execute("DELETE FROM reported_candidates_state")
+            self.connection.execute("INSERT INTO reported_candidates_state VALUES (?)", (revid,))
+
+    def clear(self) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM reported_candidates")
+            self.connection.execute("DELETE FROM reported_candidates_state")
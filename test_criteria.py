@@ -0,0 +1,265 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import calendar
+import itertools
+import random
+import re
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+from unittest import mock
+
+import pywikibot
+
+from contribstore import ContributionStore
+from contributions import Contributions
+from criteria import CriteriaChecker
+
+REPLICA_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+
+class SqliteReplica:
+    # runs the MariaDB queries of CriteriaChecker on an SQLite copy of the replica tables
+    def __init__(self) -> None:
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.create_function("FLOOR", 1, lambda value: int(value // 1))
+        self.connection.create_function(
+            "SUBTRACT_DAYS",
+            2,
+            lambda timestamp, days: (
+                datetime.strptime(timestamp, REPLICA_TIMESTAMP_FORMAT) - timedelta(days=days)
+            ).strftime(REPLICA_TIMESTAMP_FORMAT),
+        )
+        self.connection.executescript(
+            "CREATE TABLE actor_revision (actor_id INTEGER PRIMARY KEY, actor_name TEXT NOT NULL);"
+            "CREATE TABLE page (page_id INTEGER PRIMARY KEY, page_namespace INTEGER NOT NULL);"
+            "CREATE TABLE revision_userindex (rev_id INTEGER PRIMARY KEY, rev_page INTEGER NOT NULL,"
+            " rev_actor INTEGER NOT NULL, rev_timestamp TEXT NOT NULL, rev_deleted INTEGER NOT NULL);"
+            "CREATE TABLE flaggedrevs (fr_rev_id INTEGER PRIMARY KEY);"
+        )
+
+    @staticmethod
+    def translate(query: str) -> str:
+        query = re.sub(
+            r"DATE_FORMAT\(STR_TO_DATE\((.+?), '%%Y%%m%%d%%H%%i%%s'\) - INTERVAL (\d+) DAY, '%%Y%%m%%d%%H%%i%%s'\)",
+            r"SUBTRACT_DAYS(\1, \2)",
+            query,
+        )
+        return query.replace("%s", "?").replace("%%", "%")
+
+    def query(self, query: str, params: Any = None) -> List[Tuple[Any, ...]]:
+        params = params if isinstance(params, tuple) else (params,)
+        rows = self.connection.execute(self.translate(query), params).fetchall()
+        # text columns of the replica are binary
+        return [tuple(value.encode() if isinstance(value, str) else value for value in row) for row in rows]
+
+
+class FakeRequest:
+    # list=usercontribs and prop=revisions answered from the same revisions as the replica
+    revisions: List[Dict[str, Any]] = []
+    highLimits = True
+    revisionRequests = 0
+
+    def __init__(self, site: Any, parameters: Dict[str, Any]) -> None:
+        self.parameters = parameters
+
+    def submit(self) -> Dict[str, Any]:
+        if self.parameters.get("list") == "usercontribs":
+            namespaces = [int(ns) for ns in self.parameters["ucnamespace"].split("|")]
+            start = self.parameters["ucstart"].strftime(REPLICA_TIMESTAMP_FORMAT)
+            contribs = [
+                {"revid": rev["revid"], "ns": rev["ns"]}
+                for rev in sorted(self.revisions, key=lambda rev: (rev["timestamp"], rev["revid"]), reverse=True)
+                if rev["user"] == self.parameters["ucuser"]
+                and not rev["userhidden"]
+                and rev["ns"] in namespaces
+                and rev["timestamp"] <= start
+            ]
+            limit = min(int(self.parameters["uclimit"]), 5000 if self.highLimits else 500)
+            return {"query": {"usercontribs": contribs[:limit]}}
+        FakeRequest.revisionRequests += 1
+        revids = {int(revid) for revid in self.parameters["revids"].split("|")}
+        revisions = [
+            {"revid": rev["revid"], **({"flagged": {}} if rev["flagged"] else {})}
+            for rev in self.revisions
+            if rev["revid"] in revids
+        ]
+        return {"query": {"pages": {"1": {"revisions": revisions}}}}
+
+
+def fetchFakeContributions(
+    user: Any, namespaces: Optional[List[int]], total: int, start: Any = None, end: Any = None, **kwargs: Any
+) -> Contributions:
+    contribs = Contributions()
+    for rev in sorted(FakeRequest.revisions, key=lambda rev: (rev["timestamp"], rev["revid"]), reverse=True):
+        if rev["user"] != user.username or rev["userhidden"] or (namespaces is not None and rev["ns"] not in namespaces):
+            continue
+        if start is not None and rev["timestamp"] > start.strftime(REPLICA_TIMESTAMP_FORMAT):
+            continue
+        if end is not None and rev["timestamp"] < end.strftime(REPLICA_TIMESTAMP_FORMAT):
+            continue
+        if len(contribs) == total:
+            break
+        timestamp = calendar.timegm(datetime.strptime(rev["timestamp"], REPLICA_TIMESTAMP_FORMAT).timetuple())
+        contribs.append(rev["revid"], rev["ns"], timestamp)
+    return contribs
+
+
+class FlaggedEditCountTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.site = SimpleNamespace(dbName=lambda: "testwiki", has_right=lambda right: FakeRequest.highLimits)
+        self.checker = CriteriaChecker(self.site, flaggedCountBackend="replica")
+        self.replica = SqliteReplica()
+        self.checker.replica = self.replica
+        self.addCleanup(self.checker.flaggedStatusExecutor.shutdown)
+        requestPatch = mock.patch.object(pywikibot.data.api, "Request", FakeRequest)
+        requestPatch.start()
+        self.addCleanup(requestPatch.stop)
+        FakeRequest.highLimits = True
+        FakeRequest.revisions = self.createRevisions(random.Random(4))
+        self.user = self.createUser("Tester")
+
+    def createRevisions(self, rand: random.Random) -> List[Dict[str, Any]]:
+        namespaces = [0, 0, 0, 0, 1, 2, 3, 4, 6, 10, 10, 14, 828]
+        pages = [(pageId, rand.choice(namespaces)) for pageId in range(1, 400)]
+        self.replica.connection.executemany("INSERT INTO page VALUES (?, ?)", pages)
+        self.replica.connection.executemany("INSERT INTO actor_revision VALUES (?, ?)", [(1, "Tester"), (2, "Other")])
+        revisions = []
+        timestamp = datetime(2020, 6, 1)
+        for revid in range(1, 3000):
+            pageId, namespace = rand.choice(pages)
+            # a few edits within the last two days before the newest edit and some with the same timestamp
+            timestamp -= timedelta(minutes=rand.choice([0, 1, 10, 60, 600]))
+            revision = {
+                "revid": 100000 - revid,
+                "page": pageId,
+                "ns": namespace,
+                "user": rand.choice(["Tester", "Tester", "Tester", "Other"]),
+                "timestamp": timestamp.strftime(REPLICA_TIMESTAMP_FORMAT),
+                "userhidden": rand.random() < 0.03,
+                "flagged": rand.random() < 0.6,
+            }
+            revisions.append(revision)
+        self.replica.connection.executemany(
+            "INSERT INTO revision_userindex VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    rev["revid"],
+                    rev["page"],
+                    1 if rev["user"] == "Tester" else 2,
+                    rev["timestamp"],
+                    4 if rev["userhidden"] else 0,
+                )
+                for rev in revisions
+            ],
+        )
+        self.replica.connection.executemany(
+            "INSERT INTO flaggedrevs VALUES (?)", [(rev["revid"],) for rev in revisions if rev["flagged"]]
+        )
+        return revisions
+
+    @staticmethod
+    def createUser(username: str) -> SimpleNamespace:
+        lastEdit = max(
+            (rev for rev in FakeRequest.revisions if rev["user"] == username and not rev["userhidden"]),
+            key=lambda rev: (rev["timestamp"], rev["revid"]),
+        )
+        lastEditTimestamp = pywikibot.Timestamp.strptime(lastEdit["timestamp"], REPLICA_TIMESTAMP_FORMAT)
+        return SimpleNamespace(username=username, last_edit=("Page", lastEdit["revid"], lastEditTimestamp, ""))
+
+    def test_replica_chunk_counts_match_api(self) -> None:
+        replicaCounts = list(self.checker.getFlaggedEditChunkCountsFromReplica(self.user))
+        self.assertGreater(len(replicaCounts), 1)
+        self.assertEqual(replicaCounts, list(self.checker.getFlaggedEditChunkCountsFromApi(self.user)))
+
+    def test_replica_chunk_counts_match_api_without_apihighlimits(self) -> None:
+        FakeRequest.highLimits = False
+        replicaCounts = list(self.checker.getFlaggedEditChunkCountsFromReplica(self.user))
+        self.assertEqual(len(replicaCounts), 1)
+        self.assertEqual(replicaCounts, list(self.checker.getFlaggedEditChunkCountsFromApi(self.user)))
+
+    def test_flagged_edit_count_stops_after_the_chunk_reaching_200(self) -> None:
+        chunkCounts = list(self.checker.getFlaggedEditChunkCountsFromApi(self.user))
+        partialCount = next(count for count in itertools.accumulate(chunkCounts) if count >= 200)
+        self.assertLess(partialCount, sum(chunkCounts))
+        self.assertEqual(self.checker.getFlaggedEditCount(self.user, False), partialCount)
+        self.assertEqual(self.checker.getFlaggedEditCount(self.user, True), sum(chunkCounts))
+
+    def assertNoRequestsAfterEarlyStop(self) -> None:
+        chunkCounts = list(self.checker.getFlaggedEditChunkCountsFromReplica(self.user))
+        consumedChunks = next(
+            index + 1 for index, count in enumerate(itertools.accumulate(chunkCounts)) if count >= 200
+        )
+        self.assertLess(consumedChunks, len(chunkCounts))
+        FakeRequest.revisionRequests = 0
+        self.checker.getFlaggedEditCount(self.user, False)
+        # waits for requests that might still be running
+        self.checker.flaggedStatusExecutor.shutdown(wait=True)
+        self.assertEqual(FakeRequest.revisionRequests, consumedChunks)
+
+    def test_api_flagged_edit_count_makes_no_requests_after_an_early_stop(self) -> None:
+        self.checker.flaggedCountBackend = "api"
+        self.assertNoRequestsAfterEarlyStop()
+
+    def test_store_flagged_edit_count_makes_no_requests_after_an_early_stop(self) -> None:
+        self.checker.flaggedCountBackend = "api"
+        self.checker.contributionStore = ContributionStore(":memory:")
+        with mock.patch("contribstore.fetchContributions", fetchFakeContributions):
+            self.assertNoRequestsAfterEarlyStop()
+
+
+class ContributionStoreTest(unittest.TestCase):
+    def test_sync_stops_when_it_makes_no_progress(self) -> None:
+        # more contributions with the same timestamp than are fetched at once
+        FakeRequest.revisions = [
+            {"revid": revid, "ns": 0, "user": "Tester", "timestamp": "20200601000000", "userhidden": False}
+            for revid in range(1, 11)
+        ]
+        store = ContributionStore(":memory:")
+        with mock.patch("contribstore.fetchContributions", wraps=fetchFakeContributions) as fetch:
+            contribs = store.getContributions(SimpleNamespace(username="Tester"), None, datetime(2020, 5, 31), 5)
+        self.assertEqual(len(contribs), 0)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_stream_reads_the_same_contributions_page_by_page(self) -> None:
+        rand = random.Random(16)
+        timestamp = datetime(2020, 6, 1)
+        FakeRequest.revisions = []
+        for revid in range(1000, 1, -1):
+            timestamp -= timedelta(minutes=rand.choice([0, 1, 60]))
+            FakeRequest.revisions.append(
+                {
+                    "revid": revid,
+                    "ns": rand.choice([0, 1]),
+                    "user": "Tester",
+                    "timestamp": timestamp.strftime(REPLICA_TIMESTAMP_FORMAT),
+                    "userhidden": False,
+                }
+            )
+        user = SimpleNamespace(username="Tester")
+        start = datetime(2020, 6, 1)
+        with mock.patch("contribstore.fetchContributions", wraps=fetchFakeContributions) as fetch:
+            expected = ContributionStore(":memory:").getContributions(user, [0], start, 300)
+            fetch.reset_mock()
+            contribs = ContributionStore(":memory:").getContributions(user, [0], start, 300, 50)
+            self.assertTrue(contribs.ensure(10))
+            self.assertEqual(fetch.call_count, 1)
+            self.assertFalse(contribs.isComplete())
+            for index in range(len(expected)):
+                self.assertTrue(contribs.ensure(index + 1))
+            self.assertFalse(contribs.ensure(len(expected) + 1))
+        self.assertEqual(len(expected), 300)
+        self.assertEqual(list(contribs.revids), list(expected.revids))
+        self.assertEqual(list(contribs.timestamps), list(expected.timestamps))
+
+
+if __name__ == "__main__":
+    unittest.main()
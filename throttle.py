@@ -0,0 +1,50 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import pywikibot
+from pywikibot import config
+
+
+class SharedThrottle:
+    def __init__(self, site: pywikibot.site.BaseSite, lagCheckInterval: float = 30) -> None:
+        self.site = site
+        self.lagCheckInterval = lagCheckInterval
+        self.lock = threading.Lock()
+        self.nextLagCheck = 0.0
+        self.pausedUntil = 0.0
+
+    def getReplicationLag(self) -> float:
+        request = pywikibot.data.api.Request(
+            site=self.site,
+            parameters={
+                "action": "query",
+                "format": "json",
+                "meta": "siteinfo",
+                "siprop": "dbrepllag",
+                "sishowalldb": "1",
+            },
+        )
+        data = request.submit()
+        return max(float(server["lag"]) for server in data["query"]["dbrepllag"])
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.nextLagCheck:
+                self.nextLagCheck = now + self.lagCheckInterval
+                lag = self.getReplicationLag()
+                if config.maxlag and lag > config.maxlag:
+                    pause = min(lag, config.maxthrottle)
+                    print(f"Replication lag is {lag:.0f}s, pausing all workers for {pause:.0f}s.")
+                    self.pausedUntil = max(self.pausedUntil, now + pause)
+            delay = self.pausedUntil - now
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pywikibot
+
+from replica import ReplicaConnectionPool
+
+REVIEW_GROUPS = ["editor", "autoreview"]
+REGISTRATION_LOG_ACTIONS = ["newusers", "autocreate", "create2"]
+
+
+@dataclass
+class UserHistory:
+    wasBlockedBefore: bool
+    hadReviewRightsRemovedBefore: bool
+    registrationTime: Optional[pywikibot.Timestamp]
+
+
+def isReviewRightsRemoval(oldGroups: List[str], newGroups: List[str]) -> bool:
+    return any(group in oldGroups and not group in newGroups for group in REVIEW_GROUPS)
+
+
+def parsePhpSerialized(data: bytes, pos: int = 0) -> Tuple[Any, int]:
+    # only what MediaWiki writes to log_params: arrays, strings, integers, floats, booleans and null
+    kind = data[pos : pos + 1]
+    if kind == b"N":
+        return (None, pos + 2)
+    end = data.index(b":", pos + 2) if kind in [b"s", b"a"] else data.index(b";", pos + 2)
+    value = data[pos + 2 : end]
+    if kind == b"i":
+        return (int(value), end + 1)
+    if kind == b"d":
+        return (float(value), end + 1)
+    if kind == b"b":
+        return (value == b"1", end + 1)
+    if kind == b"s":
+        start = end + 2
+        return (data[start : start + int(value)].decode("utf-8"), start + int(value) + 2)
+    if kind == b"a":
+        items = {}
+        pos = end + 2
+        for _ in range(int(value)):
+            key, pos = parsePhpSerialized(data, pos)
+            items[key], pos = parsePhpSerialized(data, pos)
+        return (items, pos + 1)
+    raise ValueError(f"Unexpected serialized PHP value at {pos}: {data[pos : pos + 20]!r}")
+
+
+def parseRightsLogParams(rawParams: bytes) -> Optional[Tuple[List[str], List[str]]]:
+    # (oldgroups, newgroups) or None if the entry has no group information, like the API
+    if rawParams.startswith(b"a:"):
+        params, _ = parsePhpSerialized(rawParams)
+        oldGroups = params.get("4::oldgroups", params.get("oldgroups"))
+        newGroups = params.get("5::newgroups", params.get("newgroups"))
+        if oldGroups is None or newGroups is None:
+            return None
+        return (list(oldGroups.values()), list(newGroups.values()))
+    # legacy format: the comma separated old and new groups on two lines
+    lines = rawParams.decode("utf-8").split("\n")
+    if len(lines) < 2:
+        return None
+    oldGroups, newGroups = ([group.strip() for group in line.split(",") if group.strip()] for line in lines[:2])
+    return (oldGroups, newGroups)
+
+
+class UserHistoryCache:
+    def __init__(self, replica: ReplicaConnectionPool, chunkSize: int = 1000) -> None:
+        self.replica = replica
+        self.chunkSize = chunkSize
+        self.lock = threading.Lock()
+        self.history: Dict[str, UserHistory] = {}
+
+    def loadEventLogFlags(self, usernames: List[str]) -> Dict[str, Tuple[bool, bool]]:
+        # same semantics as CriteriaChecker.getEventLogFlags: only the newest block or rights removal counts
+        flags = {username: (False, False) for username in usernames}
+        placeholders = ",".join(["%s"] * len(usernames))
+        rows = self.replica.query(
+            "SELECT log_title, log_type, log_action, log_params FROM logging_logindex"
+            f" WHERE log_namespace=2 AND log_title IN ({placeholders}) AND log_type IN ('rights', 'block')"
+            " ORDER BY log_title, log_timestamp DESC, log_id DESC",
+            params=tuple(username.replace(" ", "_") for username in usernames),
+        )
+        decided = set()
+        for rawTitle, rawType, rawAction, rawParams in rows:
+            username = rawTitle.decode().replace("_", " ")
+            if username in decided:
+                continue
+            if rawType == b"rights":
+                groups = parseRightsLogParams(rawParams)
+                if groups is None:
+                    continue
+                if isReviewRightsRemoval(*groups):
+                    flags[username] = (False, True)
+                    decided.add(username)
+            elif rawAction == b"block":
+                flags[username] = (True, False)
+                decided.add(username)
+        return flags
+
+    def loadRegistrationTimes(self, usernames: List[str]) -> Dict[str, Optional[pywikibot.Timestamp]]:
+        # like CriteriaChecker.getUserRegistrationTimeSafe: user_registration, the newusers log, the oldest edit
+        placeholders = ",".join(["%s"] * len(usernames))
+        registrationTimes: Dict[str, Optional[pywikibot.Timestamp]] = {username: None for username in usernames}
+        for rawUsername, rawRegistration in self.replica.query(
+            f"SELECT user_name, user_registration FROM user WHERE user_name IN ({placeholders})",
+            params=tuple(usernames),
+        ):
+            if rawRegistration:
+                registrationTimes[rawUsername.decode()] = pywikibot.Timestamp.fromtimestampformat(
+                    rawRegistration.decode()
+                )
+        missing = [username for username, registrationTime in registrationTimes.items() if registrationTime is None]
+        if not missing:
+            return registrationTimes
+        placeholders = ",".join(["%s"] * len(missing))
+        logged = set()
+        for rawUsername, rawAction, rawTimestamp in self.replica.query(
+            "SELECT actor_name, log_action, log_timestamp FROM logging_userindex JOIN actor_logging ON actor_id=log_actor"
+            f" WHERE actor_name IN ({placeholders}) AND log_type='newusers'"
+            " ORDER BY actor_name, log_timestamp DESC, log_id DESC",
+            params=tuple(missing),
+        ):
+            username = rawUsername.decode()
+            if username in logged:
+                continue
+            logged.add(username)
+            # other actions are left to the per-user lookup, which does not support them either
+            if rawAction.decode() in REGISTRATION_LOG_ACTIONS:
+                registrationTimes[username] = pywikibot.Timestamp.fromtimestampformat(rawTimestamp.decode())
+        unlogged = [username for username in missing if username not in logged]
+        if not unlogged:
+            return registrationTimes
+        placeholders = ",".join(["%s"] * len(unlogged))
+        for rawUsername, rawTimestamp in self.replica.query(
+            "SELECT actor_name, MIN(rev_timestamp) FROM revision_userindex JOIN actor_revision ON actor_id=rev_actor"
+            f" WHERE actor_name IN ({placeholders}) GROUP BY actor_name",
+            params=tuple(unlogged),
+        ):
+            registrationTimes[rawUsername.decode()] = pywikibot.Timestamp.fromtimestampformat(rawTimestamp.decode())
+        return registrationTimes
+
+    def load(self, usernames: Iterable[str]) -> Dict[str, UserHistory]:
+        loaded = self.fetch(usernames)
+        with self.lock:
+            self.history.update(loaded)
+        return loaded
+
+    def fetch(self, usernames: Iterable[str]) -> Dict[str, UserHistory]:
+        # without adding the users to the cache
+        usernames = sorted(set(usernames))
+        loaded = {}
+        for i in range(0, len(usernames), self.chunkSize):
+            chunk = usernames[i : i + self.chunkSize]
+            flags = self.loadEventLogFlags(chunk)
+            registrationTimes = self.loadRegistrationTimes(chunk)
+            for username in chunk:
+                loaded[username] = UserHistory(*flags[username], registrationTimes[username])
+        return loaded
+
+    def get(self, username: str) -> Optional[UserHistory]:
+        with self.lock:
+            return self.history.get(username)
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import pywikibot
+
+
+@dataclass
+class UserMetadata:
+    username: str
+    groups: List[str]
+    rights: List[str]
+    editCount: int
+    registrationTime: Optional[pywikibot.Timestamp]
+    blocked: bool
+
+    @property
+    def isBot(self) -> bool:
+        return "bot" in self.groups
+
+
+class UserMetadataCache:
+    def __init__(self, site: pywikibot.site.BaseSite) -> None:
+        self.site = site
+        self.lock = threading.Lock()
+        self.metadata: Dict[str, UserMetadata] = {}
+
+    def getBatchSize(self) -> int:
+        return 500 if self.site.has_right("apihighlimits") else 50
+
+    def load(self, usernames: Iterable[str]) -> Dict[str, UserMetadata]:
+        usernames = sorted(set(usernames))
+        batchSize = self.getBatchSize()
+        loaded = {}
+        for i in range(0, len(usernames), batchSize):
+            usersRequest = pywikibot.data.api.Request(
+                site=self.site,
+                parameters={
+                    "action": "query",
+                    "format": "json",
+                    "list": "users",
+                    "ususers": "|".join(usernames[i : i + batchSize]),
+                    "usprop": "groups|rights|editcount|registration|blockinfo",
+                },
+            )
+            data = usersRequest.submit()
+            for entry in data["query"]["users"]:
+                if "missing" in entry or "invalid" in entry:
+                    continue
+                loaded[entry["name"]] = UserMetadata(
+                    entry["name"],
+                    entry.get("groups", []),
+                    entry.get("rights", []),
+                    entry.get("editcount", 0),
+                    pywikibot.Timestamp.fromISOformat(entry["registration"]) if entry.get("registration") else None,
+                    "blockid" in entry,
+                )
+        with self.lock:
+            self.metadata.update(loaded)
+        return loaded
+
+    def get(self, username: str) -> Optional[UserMetadata]:
+        with self.lock:
+            metadata = self.metadata.get(username)
+        if metadata is None:
+            metadata = self.load([username]).get(username)
+        return metadata